@@ -1,225 +1,1838 @@
 # backend.py (with Model Selection Parameter)
 
-import io
-import google.generativeai as genai
-from docx import Document
-from docx.shared import Pt # Import Pt for font size if needed
-from docx.enum.text import WD_ALIGN_PARAGRAPH # Required for alignment constant
-from docx.oxml.ns import qn # For setting complex script font correctly
-from docx.oxml import OxmlElement # Needed for creating font elements if missing
+from xml.sax.saxutils import escape as xml_escape
+import importlib
 import logging
 import os
-import streamlit as st
+import sys
 import json
-from google.cloud import vision
+import re
+import hashlib
+import time
+import random
+import tempfile
+import unicodedata
+import threading
+import queue
+import contextlib
+import contextvars
+import uuid
+import weakref
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# --- Lazily Imported SDKs ---
+class _LazyModule:
+    """
+    Stands in for a module and imports it on first attribute access.
+
+    The Google SDKs, python-docx, docxcompose and PyMuPDF together take over a
+    second to import; deferring them keeps `import backend` (and Streamlit worker
+    boot) fast and only pays for the SDKs a code path actually uses.
+    """
+
+    def __init__(self, module_name: str):
+        self._module_name = module_name
+        self._module = None
+
+    def __getattr__(self, attribute: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._module_name) # Thread-safe: imports hold the import lock
+        return getattr(self._module, attribute)
+
+
+genai = _LazyModule("google.generativeai")
+glm = _LazyModule("google.ai.generativelanguage")
+vision = _LazyModule("google.cloud.vision")
+api_exceptions = _LazyModule("google.api_core.exceptions")
+service_account = _LazyModule("google.oauth2.service_account")
+pymupdf = _LazyModule("pymupdf") # PyMuPDF
+docx = _LazyModule("docx")
+docx_text = _LazyModule("docx.enum.text") # WD_ALIGN_PARAGRAPH, for the alignment constant
+docx_ns = _LazyModule("docx.oxml.ns") # qn (complex script font) and nsdecls
+docx_oxml = _LazyModule("docx.oxml") # OxmlElement and parse_xml (bulk paragraph appends)
+docxcompose = _LazyModule("docxcompose.composer")
+
+# --- Configure Logging ---
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(module)s - %(message)s')
+
+# --- Vision OCR Tuning ---
+# The synchronous files:annotate endpoint only annotates up to 5 pages per request,
+# so larger PDFs are split into page ranges and sent as separate requests.
+VISION_PAGES_PER_REQUEST = 5
+VISION_MAX_CONCURRENCY = 4 # Max Vision requests in flight for a single PDF
+
+# --- Text Layer Fast Path Tuning ---
+# Pages whose embedded text passes these checks are read locally instead of OCR'd.
+TEXT_LAYER_MIN_CHARS = 20 # Fewer visible characters than this means an image-only page
+TEXT_LAYER_MIN_ARABIC_RATIO = 0.6 # Share of letters that must be (unshaped) Arabic letters
+TEXT_LAYER_MIN_GLYPH_COVERAGE = 0.98 # Share of characters that must map to real Unicode
+
+# --- Gemini Chunking Settings ---
+GEMINI_CHARS_PER_TOKEN = 3 # Rough average for Arabic text; used to estimate tokens offline
+GEMINI_DEFAULT_CHUNK_TOKENS = 6000 # Keeps each chunk's output under the model's output-token limit
+GEMINI_MAX_CONCURRENCY = 4 # Max Gemini requests in flight for a single document
+
+# --- Batch Pipeline Settings ---
+BATCH_STAGE_WORKERS = {"ocr": 3, "llm": 3, "docx": 1} # Worker threads per pipeline stage
+BATCH_QUEUE_SIZE = 4 # Max files waiting between two pipeline stages
+
+# --- Rate Limit and Retry Settings ---
+# Requests/tokens per minute for "vision", "gemini" (default for all Gemini models)
+# or a specific Gemini model name. Vision "requests" are counted per page.
+RATE_LIMITS = {
+    "vision": {"requests_per_minute": 1800, "tokens_per_minute": None},
+    "gemini": {"requests_per_minute": 1000, "tokens_per_minute": 4_000_000},
+}
+API_MAX_RETRIES = 5 # Retries for 429s, transient 5xx and timeouts
+API_RETRY_BASE_DELAY = 1.0 # Seconds; doubles on every retry (with full jitter)
+API_RETRY_MAX_DELAY = 60.0
+
+# --- Memory Budget Settings ---
+# Document buffers share this budget: a buffer spills to a temporary file once it outgrows
+# its own share, or once all live buffers together would hold more, so the .docx data of a
+# batch does not pile up in memory. Only the buffers are bounded: process_batch still keeps
+# every file's raw and processed text in its results, and merging builds the whole final
+# document tree in memory before saving it.
+MEMORY_BUDGET_BYTES = int(os.environ.get("ARABICPDF_MEMORY_BUDGET_MB", "256")) * 1024 * 1024
+MEMORY_BUDGET_BUFFER_SHARE = 16 # Roughly the most buffers alive at once in a batch
+PDF_HASH_READ_SIZE = 1024 * 1024 # Chunk size when hashing PDFs read from disk
+
+# --- Result Cache Settings ---
+# OCR and Gemini results are cached on disk so unchanged files cost no API calls.
+RESULT_CACHE_DIR = os.environ.get("ARABICPDF_CACHE_DIR", os.path.join(tempfile.gettempdir(), "arabicpdf_cache"))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("ARABICPDF_CACHE_MAX_MB", "512")) * 1024 * 1024
+RESULT_CACHE_LOW_WATER = 0.9 # Eviction frees space down to this share of the limit, not just under it
+
+# --- Scan Preprocessing Settings ---
+# Optional: pages bound for Vision are analysed first so blank pages are skipped,
+# repeated pages (covers, separators) are OCR'd once, and oversized scans are
+# re-rendered at PREPROCESS_TARGET_DPI when that makes the upload smaller.
+PREPROCESS_ENABLED = os.environ.get("ARABICPDF_PREPROCESS", "0") == "1" # Default for extract_pages_from_pdf
+PREPROCESS_TARGET_DPI = 200 # Resolution pages are re-rendered at for Vision
+PREPROCESS_OVERSIZE_FACTOR = 1.25 # Only re-render scans above this multiple of the target DPI
+PREPROCESS_JPEG_QUALITY = 85
+PREPROCESS_ANALYSIS_DPI = 50 # Low-resolution render used for blank detection and hashing
+PREPROCESS_INK_THRESHOLD = 160 # Gray levels below this count as ink
+PREPROCESS_BLANK_MAX_INK_RATIO = 0.0001 # Pages with less ink than this are blank (~25 pixels on A4)
+PREPROCESS_HASH_SIZE = 16 # dHash grid; 16 gives a 256-bit hash
+PREPROCESS_HASH_INDEX_SIZE = 10000 # Page keys (dHash + content digest) remembered across files
+
+# --- Instrumentation Settings ---
+METRICS_MAX_SPANS = 20000 # Most recent spans kept in memory for summaries
+# If set, every span is also appended to this file as one JSON object per line
+METRICS_JSONL_PATH = os.environ.get("ARABICPDF_METRICS_JSONL")
+
+
+# --- Instrumentation ---
+# Numeric fields a span may carry; they are summed per stage in summaries and exports.
+SPAN_COUNTERS = ("bytes", "pages", "chars", "tokens")
+
+_current_batch_id = contextvars.ContextVar("arabicpdf_batch_id", default=None)
+
+
+class MetricsRecorder:
+    """
+    Collects timing spans and passes each one to the registered sinks.
+
+    A span is a dict with "name", "batch_id", "start" (epoch seconds), "seconds",
+    "error" (bool) and any of SPAN_COUNTERS. The most recent METRICS_MAX_SPANS spans
+    are kept for per-batch summaries; per-stage totals are kept for the whole
+    process so exported counters never go backwards.
+    """
+
+    def __init__(self, max_spans: int = METRICS_MAX_SPANS):
+        self._lock = threading.Lock()
+        self._spans = deque(maxlen=max_spans)
+        self._totals = {} # stage name -> {"count", "errors", "seconds", *SPAN_COUNTERS}
+        self._sinks = []
+
+    def add_sink(self, sink):
+        """Registers a callable that receives every finished span dict."""
+        with self._lock:
+            self._sinks.append(sink)
+
+    def remove_sink(self, sink):
+        with self._lock:
+            if sink in self._sinks:
+                self._sinks.remove(sink)
+
+    def record(self, span_record: dict):
+        with self._lock:
+            self._spans.append(span_record)
+            totals = self._totals.setdefault(
+                span_record["name"], {"count": 0, "errors": 0, "seconds": 0.0, **dict.fromkeys(SPAN_COUNTERS, 0)}
+            )
+            totals["count"] += 1
+            totals["errors"] += 1 if span_record.get("error") else 0
+            totals["seconds"] += span_record["seconds"]
+            for counter in SPAN_COUNTERS:
+                totals[counter] += span_record.get(counter) or 0
+            sinks = list(self._sinks)
+        for sink in sinks:
+            try:
+                sink(span_record)
+            except Exception as e:
+                logging.warning(f"Metrics sink {sink!r} failed: {e}")
+
+    def spans(self, batch_id: str = None):
+        with self._lock:
+            return [dict(span_record) for span_record in self._spans if batch_id is None or span_record["batch_id"] == batch_id]
+
+    def totals(self):
+        with self._lock:
+            return {name: dict(totals) for name, totals in self._totals.items()}
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+            self._totals = {}
+
+
+_metrics = MetricsRecorder()
+
+
+@contextlib.contextmanager
+def span(name: str, **fields):
+    """
+    Times the enclosed block and records it as a span named name.
+
+    Yields the span dict, so the block can add counters it only knows at the end
+    (e.g. record["chars"] = len(text)) or set record["error"] = True when it
+    handles a failure itself. An exception escaping the block marks the span as
+    an error and is re-raised.
+    """
+    span_record = {"name": name, "batch_id": _current_batch_id.get(), "start": time.time(), "error": False, **fields}
+    start = time.perf_counter()
+    try:
+        yield span_record
+    except BaseException:
+        span_record["error"] = True
+        raise
+    finally:
+        span_record["seconds"] = time.perf_counter() - start
+        _metrics.record(span_record)
+
+
+@contextlib.contextmanager
+def batch_context(batch_id: str):
+    """Attaches batch_id to every span recorded in the enclosed block."""
+    token = _current_batch_id.set(batch_id)
+    try:
+        yield batch_id
+    finally:
+        _current_batch_id.reset(token)
+
+
+def _submit_in_context(executor, fn, *args):
+    """executor.submit that keeps the caller's context (and so its batch ID) in the worker."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+class JsonLinesSink:
+    """Metrics sink that appends every span to a file as one JSON object per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, span_record: dict):
+        line = json.dumps(span_record, ensure_ascii=False)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+def add_metrics_sink(sink):
+    """Registers a callable that receives every finished span dict (see MetricsRecorder)."""
+    _metrics.add_sink(sink)
+
+
+def remove_metrics_sink(sink):
+    _metrics.remove_sink(sink)
+
+
+def get_spans(batch_id: str = None):
+    """Returns the recorded spans, optionally only those of one batch."""
+    return _metrics.spans(batch_id)
+
+
+def clear_metrics():
+    _metrics.clear()
+
+
+def summarize_spans(spans: list[dict]):
+    """
+    Aggregates spans per stage, slowest total first.
+
+    Returns:
+        list[dict]: One row per stage with "stage", "count", "errors", "total_s",
+            "mean_s", "p95_s", "max_s" and the summed SPAN_COUNTERS.
+    """
+    durations_by_stage = {}
+    rows = {}
+    for span_record in spans:
+        row = rows.setdefault(span_record["name"], {"stage": span_record["name"], "count": 0, "errors": 0, **dict.fromkeys(SPAN_COUNTERS, 0)})
+        row["count"] += 1
+        row["errors"] += 1 if span_record.get("error") else 0
+        for counter in SPAN_COUNTERS:
+            row[counter] += span_record.get(counter) or 0
+        durations_by_stage.setdefault(span_record["name"], []).append(span_record["seconds"])
+
+    for stage_name, row in rows.items():
+        durations = sorted(durations_by_stage[stage_name])
+        row["total_s"] = round(sum(durations), 3)
+        row["mean_s"] = round(row["total_s"] / len(durations), 3)
+        row["p95_s"] = round(durations[min(len(durations) - 1, int(0.95 * len(durations)))], 3)
+        row["max_s"] = round(durations[-1], 3)
+    return sorted(rows.values(), key=lambda row: row["total_s"], reverse=True)
+
+
+def get_batch_summary(batch_id: str):
+    """Per-stage summary table (see summarize_spans) for one batch, e.g. for st.table."""
+    return summarize_spans(get_spans(batch_id))
+
+
+def export_prometheus() -> str:
+    """
+    Renders the process-wide per-stage totals in the Prometheus text exposition format.
+    """
+    metric_help = {
+        "count": ("arabicpdf_stage_calls_total", "Spans recorded per stage."),
+        "errors": ("arabicpdf_stage_errors_total", "Spans per stage that ended in an error."),
+        "seconds": ("arabicpdf_stage_seconds_total", "Wall-clock seconds spent per stage."),
+        "bytes": ("arabicpdf_stage_bytes_total", "Bytes processed per stage."),
+        "pages": ("arabicpdf_stage_pages_total", "PDF pages processed per stage."),
+        "chars": ("arabicpdf_stage_chars_total", "Characters processed per stage."),
+        "tokens": ("arabicpdf_stage_tokens_total", "Estimated tokens processed per stage."),
+    }
+    totals = _metrics.totals()
+    lines = []
+    for field, (metric_name, help_text) in metric_help.items():
+        lines.append(f"# HELP {metric_name} {help_text}")
+        lines.append(f"# TYPE {metric_name} counter")
+        for stage_name in sorted(totals):
+            lines.append(f'{metric_name}{{stage="{stage_name}"}} {totals[stage_name][field]}')
+    return "\n".join(lines) + "\n"
+
+
+def export_json_lines(spans: list[dict] = None) -> str:
+    """Renders spans (default: all recorded) as JSON lines."""
+    spans = get_spans() if spans is None else spans
+    return "".join(json.dumps(span_record, ensure_ascii=False) + "\n" for span_record in spans)
+
+
+if METRICS_JSONL_PATH:
+    add_metrics_sink(JsonLinesSink(METRICS_JSONL_PATH))
+
+
+# --- Vision Credentials (resolved on first use, in memory) ---
+CREDENTIALS_SECRET_NAME = "GOOGLE_CREDENTIALS_JSON" # Streamlit secret (or env var) holding the service account JSON
+
+_credentials_lock = threading.Lock()
+_resolved_credentials = None # (credentials | None, error | None) once resolved
+
+
+def _read_credentials_secret():
+    """
+    Returns the service account secret from Streamlit Secrets or the environment, or None.
+
+    Streamlit Secrets are only consulted when Streamlit is already loaded (i.e.
+    inside the app), so scripts importing backend never pay for importing it.
+    """
+    if "streamlit" in sys.modules:
+        try:
+            secrets = sys.modules["streamlit"].secrets
+            if CREDENTIALS_SECRET_NAME in secrets:
+                return secrets[CREDENTIALS_SECRET_NAME]
+        except Exception:
+            pass # No secrets file: fall through to the environment
+    return os.environ.get(CREDENTIALS_SECRET_NAME)
+
+
+def _parse_service_account_info(secret) -> dict:
+    """
+    Parses the service account secret (a JSON string or a Streamlit/TOML table) into a dict.
+
+    Private keys pasted with literal "\\n" or "\\r\\n" sequences are normalized to
+    real newlines. Key material is never logged.
+
+    Raises:
+        ValueError: If the secret is empty or not valid JSON.
+    """
+    if not isinstance(secret, str):
+        info = dict(secret)
+    elif not secret.strip():
+        raise ValueError(f"{CREDENTIALS_SECRET_NAME} is empty.")
+    else:
+        # strict=False accepts raw line breaks inside strings, as in keys pasted into TOML
+        info = json.loads(secret, strict=False)
+
+    private_key = info.get("private_key")
+    if isinstance(private_key, str):
+        cleaned_key = private_key.replace('\r\n', '\n').replace('\r', '\n').replace('\\n', '\n')
+        if cleaned_key != private_key:
+            logging.warning("Normalized line breaks in the service account private_key.")
+            info["private_key"] = cleaned_key
+    return info
+
+
+def _resolve_vision_credentials():
+    """
+    Resolves the Vision API credentials once per process, without touching disk.
+
+    The GOOGLE_CREDENTIALS_JSON secret (Streamlit Secrets, else environment) is
+    turned into in-memory service account credentials. Without it, the Vision
+    client falls back to the GOOGLE_APPLICATION_CREDENTIALS file, which is only
+    checked for existence here.
+
+    Returns:
+        tuple: (credentials, error). credentials is a service_account.Credentials or
+            None (use GOOGLE_APPLICATION_CREDENTIALS); error is None or an "Error:" string.
+    """
+    global _resolved_credentials
+    with _credentials_lock:
+        if _resolved_credentials is not None:
+            return _resolved_credentials
+
+        with span("credentials_setup") as credentials_span:
+            credentials, error = None, None
+            secret = _read_credentials_secret()
+            external_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
+            if secret is not None:
+                try:
+                    info = _parse_service_account_info(secret)
+                    credentials = service_account.Credentials.from_service_account_info(
+                        info, scopes=["https://www.googleapis.com/auth/cloud-platform"]
+                    )
+                    logging.info(f"Vision credentials loaded from {CREDENTIALS_SECRET_NAME} for {info.get('client_email', 'unknown account')}.")
+                except Exception as e:
+                    # Only the exception type: messages from key parsing can quote key material
+                    logging.error(f"Could not load Vision credentials from {CREDENTIALS_SECRET_NAME}: {type(e).__name__}")
+                    error = "Error: Vision API authentication failed (Credentials setup failed)."
+            elif external_path:
+                if os.path.exists(external_path):
+                    logging.info(f"Using GOOGLE_APPLICATION_CREDENTIALS file: {external_path}")
+                else:
+                    logging.error(f"GOOGLE_APPLICATION_CREDENTIALS path not found: {external_path}")
+                    error = "Error: Vision API credentials file missing or inaccessible at runtime."
+            else:
+                logging.warning(f"Vision API Credentials NOT found: Neither {CREDENTIALS_SECRET_NAME} nor GOOGLE_APPLICATION_CREDENTIALS is set.")
+                error = "Error: Vision API authentication failed (Credentials setup failed)."
+            credentials_span["error"] = error is not None
+
+        _resolved_credentials = (credentials, error)
+        return _resolved_credentials
+
+
+def _reset_vision_credentials():
+    """Forgets the resolved credentials so the next Vision call resolves them again."""
+    global _resolved_credentials
+    with _credentials_lock:
+        _resolved_credentials = None
+
+
+
+# --- Shared API Clients ---
+class _GeminiModel:
+    """
+    Calls one Gemini model through a given GenerativeServiceClient, with the
+    generate_content interface of genai.GenerativeModel (text prompts only).
+
+    GenerativeModel always uses the client of the process-global genai.configure(),
+    so it cannot keep one client per API key without touching its private state.
+    This builds the same request from the public protos and wraps the reply in the
+    same public response type.
+    """
+
+    def __init__(self, service_client, model_name: str):
+        self.service_client = service_client
+        self.model_name = model_name if "/" in model_name else f"models/{model_name}"
+
+    def generate_content(self, prompt: str, stream: bool = False):
+        request = glm.GenerateContentRequest(
+            model=self.model_name, contents=[glm.Content(role="user", parts=[glm.Part(text=prompt)])]
+        )
+        if stream:
+            return genai.types.GenerateContentResponse.from_iterator(self.service_client.stream_generate_content(request))
+        return genai.types.GenerateContentResponse.from_response(self.service_client.generate_content(request))
+
+
+class _ClientRegistry:
+    """
+    Holds long-lived API clients so they are built once per process, not per call.
+
+    The Vision client (and its gRPC channel) is shared by every thread. Gemini
+    models (_GeminiModel) are cached per (api_key, model_name), and each API key
+    gets its own GenerativeServiceClient, so concurrent workers never need the process-global
+    genai.configure() state. All methods are thread-safe; clients are created
+    lazily on first use.
+
+    Overrides (see override_api_clients) replace the real clients, e.g. with
+    local stand-ins for offline benchmarks.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vision_client = None
+        self._gemini_service_clients = {} # api_key -> GenerativeServiceClient
+        self._gemini_models = {} # (api_key, model_name) -> GenerativeModel
+        self.vision_override = None
+        self.gemini_model_factory = None # (api_key, model_name) -> model, or None
+
+    def get_vision_client(self):
+        if self.vision_override is not None:
+            return self.vision_override
+        with self._lock:
+            if self._vision_client is None:
+                credentials, _ = _resolve_vision_credentials()
+                logging.info("Initializing Google Cloud Vision client.")
+                with span("vision_client_init"):
+                    self._vision_client = vision.ImageAnnotatorClient(credentials=credentials)
+                logging.info("Vision client initialized successfully.")
+            return self._vision_client
+
+    def get_gemini_model(self, api_key: str, model_name: str):
+        if self.gemini_model_factory is not None:
+            return self.gemini_model_factory(api_key, model_name)
+        with self._lock:
+            model = self._gemini_models.get((api_key, model_name))
+            if model is None:
+                service_client = self._gemini_service_clients.get(api_key)
+                if service_client is None:
+                    with span("gemini_client_init"):
+                        service_client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+                    self._gemini_service_clients[api_key] = service_client
+                logging.info(f"Initializing Gemini model: {model_name}")
+                model = _GeminiModel(service_client, model_name)
+                self._gemini_models[(api_key, model_name)] = model
+            return model
+
+    def close(self):
+        """Closes every client's channel. The next call to a getter builds a fresh client."""
+        with self._lock:
+            clients = list(self._gemini_service_clients.values())
+            if self._vision_client is not None:
+                clients.append(self._vision_client)
+            self._vision_client = None
+            self._gemini_service_clients = {}
+            self._gemini_models = {}
+        for client in clients:
+            try:
+                client.transport.close()
+            except Exception as e:
+                logging.warning(f"Error closing API client channel: {e}")
+
+
+_client_registry = _ClientRegistry()
+
+def get_vision_client():
+    """Returns the process-wide Vision ImageAnnotatorClient, creating it on first use."""
+    return _client_registry.get_vision_client()
+
+
+def get_gemini_model(api_key: str, model_name: str):
+    """Returns the cached GenerativeModel for this API key and model, creating it on first use."""
+    return _client_registry.get_gemini_model(api_key, model_name)
+
+
+def override_api_clients(vision_client=None, gemini_model_factory=None):
+    """
+    Replaces the real API clients, e.g. with local stand-ins for offline benchmarks.
+
+    Args:
+        vision_client: Used instead of the Vision ImageAnnotatorClient (it needs a
+            batch_annotate_files method). Vision credentials are not checked while set.
+        gemini_model_factory (callable): Called as factory(api_key, model_name) instead
+            of building a GenerativeModel; the result needs a generate_content method.
+        Passing neither restores the real clients.
+    """
+    _client_registry.vision_override = vision_client
+    _client_registry.gemini_model_factory = gemini_model_factory
+
+
+def close_clients():
+    """Closes all cached Vision and Gemini clients (e.g. on shutdown)."""
+    _client_registry.close()
+
+
+def refresh_clients():
+    """
+    Drops all cached clients so the next call rebuilds them, e.g. after credentials
+    were rotated or a channel got into a bad state.
+    """
+    logging.info("Refreshing Vision and Gemini API clients.")
+    _client_registry.close()
+    _reset_vision_credentials()
+
+
+# --- Rate Limiting and Retries ---
+class RetryableAPIError(Exception):
+    """Raised for API errors reported inside a response that are worth retrying (e.g. quota)."""
+
+
+_retryable_exceptions_tuple = None
+
+def _retryable_exceptions():
+    """google.api_core exceptions for 429s, transient 5xx and timeouts (built on first use)."""
+    global _retryable_exceptions_tuple
+    if _retryable_exceptions_tuple is None:
+        _retryable_exceptions_tuple = (
+            RetryableAPIError,
+            api_exceptions.TooManyRequests,
+            api_exceptions.ResourceExhausted,
+            api_exceptions.InternalServerError,
+            api_exceptions.BadGateway,
+            api_exceptions.ServiceUnavailable,
+            api_exceptions.GatewayTimeout,
+            api_exceptions.DeadlineExceeded,
+            api_exceptions.Aborted,
+            ConnectionError,
+        )
+    return _retryable_exceptions_tuple
+
+# google.rpc codes in Vision error statuses that are worth retrying:
+# DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, ABORTED, INTERNAL, UNAVAILABLE
+_RETRYABLE_STATUS_CODES = {4, 8, 10, 13, 14}
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket refilled continuously at rate_per_minute, holding
+    at most one minute's worth of tokens.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = float(rate_per_minute)
+        self._refill_per_second = rate_per_minute / 60.0
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """
+        Takes `amount` tokens, sleeping until enough are available.
+        Requests larger than the bucket are clamped to its capacity so they still pass.
+
+        Returns:
+            float: Seconds spent waiting.
+        """
+        amount = min(float(amount), self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self._refill_per_second)
+                self._last_refill = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return waited
+                wait_seconds = (amount - self._tokens) / self._refill_per_second
+            time.sleep(wait_seconds)
+            waited += wait_seconds
+
+
+class RateLimiter:
+    """
+    Per-key (e.g. "vision" or a Gemini model name) request and token budgets,
+    plus counters for retries, throttle waits and final failures per service.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limits = {} # key -> {"requests_per_minute": ..., "tokens_per_minute": ...}
+        self._buckets = {} # (key, "requests" | "tokens") -> TokenBucket
+        self._stats = {}
+
+    def configure(self, key: str, requests_per_minute: float = None, tokens_per_minute: float = None):
+        """Sets the limits for a key. None means unlimited."""
+        with self._lock:
+            self._limits[key] = {"requests_per_minute": requests_per_minute, "tokens_per_minute": tokens_per_minute}
+            self._buckets = {} # Rebuilt lazily; a "gemini" change affects every model's buckets
+
+    def _get_bucket(self, key: str, kind: str):
+        with self._lock:
+            if (key, kind) not in self._buckets:
+                limits = self._limits.get(key) or self._limits.get("gemini" if key != "vision" else "vision", {})
+                rate = limits.get(f"{kind}_per_minute")
+                self._buckets[(key, kind)] = TokenBucket(rate) if rate else None
+            return self._buckets[(key, kind)]
+
+    def acquire(self, service: str, key: str, requests: float = 1, tokens: float = 0):
+        """Blocks until `requests` requests and `tokens` tokens are allowed for key."""
+        waited = 0.0
+        request_bucket = self._get_bucket(key, "requests")
+        if request_bucket:
+            waited += request_bucket.acquire(requests)
+        token_bucket = self._get_bucket(key, "tokens")
+        if token_bucket and tokens:
+            waited += token_bucket.acquire(tokens)
+        if waited > 0:
+            self.record(service, "throttle_waits")
+            self.record(service, "throttle_wait_seconds", waited)
+
+    def record(self, service: str, counter: str, amount: float = 1):
+        with self._lock:
+            service_stats = self._stats.setdefault(service, {
+                "calls": 0, "retries": 0, "throttle_waits": 0, "throttle_wait_seconds": 0.0, "final_failures": 0,
+            })
+            service_stats[counter] += amount
+
+    def stats(self):
+        with self._lock:
+            return {service: dict(counters) for service, counters in self._stats.items()}
+
+
+_rate_limiter = RateLimiter()
+for _limit_key, _limits in RATE_LIMITS.items():
+    _rate_limiter.configure(_limit_key, **_limits)
+
+
+def configure_rate_limit(key: str, requests_per_minute: float = None, tokens_per_minute: float = None):
+    """
+    Sets the request and token budgets for "vision", "gemini" (the default for every
+    Gemini model) or a specific Gemini model name. None means unlimited.
+    """
+    _rate_limiter.configure(key, requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+
+
+def get_rate_limit_stats():
+    """
+    Returns:
+        dict: Per service ("vision", "gemini"): "calls", "retries", "throttle_waits",
+              "throttle_wait_seconds" and "final_failures".
+    """
+    return _rate_limiter.stats()
+
+
+def _call_with_retries(service: str, limit_key: str, call, requests: float = 1, tokens: float = 0):
+    """
+    Runs call() under the rate limit for limit_key, retrying retryable errors with
+    jittered exponential backoff (up to API_MAX_RETRIES retries).
+    Non-retryable errors and the last retryable one are re-raised.
+    """
+    for attempt in range(API_MAX_RETRIES + 1):
+        _rate_limiter.acquire(service, limit_key, requests=requests, tokens=tokens)
+        _rate_limiter.record(service, "calls")
+        try:
+            return call()
+        except _retryable_exceptions() as e:
+            if attempt == API_MAX_RETRIES:
+                _rate_limiter.record(service, "final_failures")
+                logging.error(f"{service} call failed after {API_MAX_RETRIES} retries: {e}")
+                raise
+            # Full jitter keeps concurrent workers from retrying in lockstep
+            delay = random.uniform(0, min(API_RETRY_MAX_DELAY, API_RETRY_BASE_DELAY * (2 ** attempt)))
+            _rate_limiter.record(service, "retries")
+            logging.warning(f"{service} call failed with retryable error ({type(e).__name__}: {e}). Retry {attempt + 1}/{API_MAX_RETRIES} in {delay:.1f}s.")
+            time.sleep(delay)
+        except Exception:
+            _rate_limiter.record(service, "final_failures")
+            raise
+
+
+# --- Bounded-Memory Buffers and PDF Sources ---
+def configure_memory_budget(budget_bytes: int):
+    """Sets the memory budget used to decide when buffers spill to disk."""
+    global MEMORY_BUDGET_BYTES
+    MEMORY_BUDGET_BYTES = budget_bytes
+    logging.info(f"Memory budget set to {budget_bytes} bytes (buffers spill to disk above {_spill_threshold_bytes()} bytes).")
+
+
+def _spill_threshold_bytes() -> int:
+    """Size above which a single buffer is moved from memory to a temporary file."""
+    return max(1024 * 1024, MEMORY_BUDGET_BYTES // MEMORY_BUDGET_BUFFER_SHARE)
+
+
+class _BufferMemory:
+    """Process-wide count of the bytes live document buffers hold in memory."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bytes = 0
+
+    def add(self, amount: int) -> int:
+        """Counts amount more bytes and returns the new total."""
+        with self._lock:
+            self._bytes += amount
+            return self._bytes
+
+    def release(self, buffer_bytes: list):
+        """Stops counting a buffer's bytes (buffer_bytes is its one-element counter, reset to 0)."""
+        with self._lock:
+            self._bytes -= buffer_bytes[0]
+            buffer_bytes[0] = 0
+
+    @property
+    def total(self) -> int:
+        with self._lock:
+            return self._bytes
+
+
+_buffer_memory = _BufferMemory()
+
+
+class _DocumentBuffer(tempfile.SpooledTemporaryFile):
+    """
+    A SpooledTemporaryFile whose in-memory bytes count against MEMORY_BUDGET_BYTES
+    together with those of every other live buffer. It spills to its temporary
+    file when it outgrows spill_threshold, or when a write takes the total over
+    the budget.
+    """
+
+    def __init__(self, spill_threshold: int):
+        super().__init__(max_size=0, mode="w+b") # Spilling is decided in write, not by the base class
+        self._spill_threshold = spill_threshold
+        self._in_memory = True
+        # A list so the finalizer can release it without keeping the buffer alive
+        self._memory_bytes = [0]
+        weakref.finalize(self, _buffer_memory.release, self._memory_bytes)
+
+    def write(self, data) -> int:
+        written = super().write(data)
+        if self._in_memory:
+            # Overwrites are counted again, which only makes the buffer spill a little early
+            self._memory_bytes[0] += written
+            total_bytes = _buffer_memory.add(written)
+            if self._memory_bytes[0] > self._spill_threshold or total_bytes > MEMORY_BUDGET_BYTES:
+                self.rollover()
+        return written
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def rollover(self):
+        super().rollover()
+        if self._in_memory:
+            self._in_memory = False
+            _buffer_memory.release(self._memory_bytes)
+
+    def close(self):
+        super().close()
+        _buffer_memory.release(self._memory_bytes)
+
+
+def new_document_buffer():
+    """
+    Returns a binary read/write buffer for document data that lives in memory while
+    small and transparently spills to a temporary file once it outgrows its share
+    of MEMORY_BUDGET_BYTES, or once all live buffers together would go over the
+    budget. The temporary file is deleted when the buffer is closed.
+    """
+    return _DocumentBuffer(_spill_threshold_bytes())
+
+
+def read_buffer(buffer) -> bytes:
+    """Returns the full contents of a document buffer (e.g. for a download), regardless of position."""
+    buffer.seek(0)
+    data = buffer.read()
+    buffer.seek(0)
+    return data
+
+
+def _disk_file_path(file_obj):
+    """
+    Returns the path of a file object that is an open file on disk, else None.
+
+    .name alone is not trusted: in-memory streams such as Streamlit's UploadedFile
+    carry the client's file name, which may well name some other file on the
+    server. The path only counts if it is the very file behind file_obj.fileno().
+    """
+    name = getattr(file_obj, "name", None)
+    if not isinstance(name, str) or not hasattr(file_obj, "fileno"):
+        return None
+    try:
+        return name if os.path.samestat(os.fstat(file_obj.fileno()), os.stat(name)) else None
+    except (OSError, ValueError): # No OS-level file behind it (io.UnsupportedOperation), or no such path
+        return None
+
+
+def _open_pdf_source(pdf_source):
+    """
+    Opens a PDF without copying it into a new bytes object where possible.
+
+    In-memory streams such as io.BytesIO or Streamlit's UploadedFile are opened
+    through a zero-copy view of their buffer; paths and files opened from disk are
+    opened by PyMuPDF straight from the file. Other file objects are read.
+
+    Args:
+        pdf_source: A path (str or os.PathLike) or a file-like object.
+
+    Returns:
+        tuple: (pdf_doc, content_hash, size_bytes). pdf_doc is None if the PDF is empty.
+    """
+    source_path = None
+    if isinstance(pdf_source, (str, os.PathLike)):
+        source_path = os.fspath(pdf_source)
+    elif not hasattr(pdf_source, "getbuffer"):
+        source_path = _disk_file_path(pdf_source)
+
+    if source_path is not None:
+        size = os.path.getsize(source_path)
+        if not size:
+            return None, None, 0
+        content_hash = hashlib.sha256()
+        with open(source_path, "rb") as f:
+            for block in iter(lambda: f.read(PDF_HASH_READ_SIZE), b""):
+                content_hash.update(block)
+        logging.info(f"Opening {size}-byte PDF from file: {source_path}")
+        return pymupdf.open(source_path, filetype="pdf"), content_hash.hexdigest(), size
+
+    if hasattr(pdf_source, "getbuffer"):
+        content = pdf_source.getbuffer() # Zero-copy view of the in-memory stream
+    else:
+        pdf_source.seek(0)
+        content = pdf_source.read()
+    size = len(content)
+    logging.info(f"Read {size} bytes from PDF stream.")
+    if not size:
+        return None, None, 0
+    return pymupdf.open(stream=content, filetype="pdf"), hashlib.sha256(content).hexdigest(), size
+
+
+# --- Persistent Result Cache ---
+def _sha256_hex(data) -> str:
+    """Returns the SHA-256 hex digest of bytes or a str (encoded as UTF-8)."""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultCache:
+    """
+    A content-addressed, size-bounded cache of text results stored on disk.
+
+    Entries live in <directory>/<namespace>/<key> and survive restarts, so
+    re-processing unchanged inputs costs no API calls. Entry sizes and recency are
+    tracked in memory (seeded from the directory and file modification times at
+    start-up): hits move an entry to the back, and when the total size goes over
+    max_bytes the least recently used entries are deleted until it is down to
+    RESULT_CACHE_LOW_WATER of max_bytes, so a full cache does not evict on every put.
+    Writes are atomic (temp file + rename), so several workers can share a directory.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        # path -> size, least recently used first
+        self._entries = {path: size for _, path, size in sorted(self._list_entries())}
+        self._total_bytes = sum(self._entries.values())
+
+    def _path(self, namespace: str, key: str) -> str:
+        return os.path.join(self.directory, namespace, key)
+
+    def _list_entries(self):
+        """Returns (mtime, path, size) for every cached entry."""
+        entries = []
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue # Evicted by another worker
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def get(self, namespace: str, key: str):
+        """
+        Looks up a cached value.
+
+        Returns:
+            str | None: The cached text, or None on a miss.
+        """
+        path = self._path(namespace, key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = f.read()
+        except OSError:
+            with self._lock:
+                self._misses += 1
+            return None
+        try:
+            os.utime(path) # Keeps recency across restarts
+        except OSError:
+            pass
+        with self._lock:
+            self._hits += 1
+            size = self._entries.pop(path, None)
+            if size is None: # Written by another process sharing the directory
+                size = len(value.encode("utf-8"))
+                self._total_bytes += size
+            self._entries[path] = size # Most recently used
+        return value
+
+    def put(self, namespace: str, key: str, value: str):
+        """Stores a value, evicting least recently used entries if over budget."""
+        path = self._path(namespace, key)
+        encoded = value.encode("utf-8")
+        if len(encoded) > self.max_bytes:
+            logging.warning(f"Not caching {namespace} result of {len(encoded)} bytes: larger than the whole cache.")
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(encoded)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not write {namespace} cache entry: {e}")
+            return
+        with self._lock:
+            self._total_bytes += len(encoded) - self._entries.pop(path, 0)
+            self._entries[path] = len(encoded)
+            evicted_paths = self._take_evictions() if self._total_bytes > self.max_bytes else []
+        for evicted_path in evicted_paths: # Deleted outside the lock, so other workers are not held up
+            try:
+                os.remove(evicted_path)
+            except FileNotFoundError:
+                pass # Already evicted by another process
+
+    def _take_evictions(self):
+        """
+        Drops least recently used entries from the index until the total is at the
+        low-water mark and returns their paths for deletion. Caller holds the lock.
+        """
+        target_bytes = self.max_bytes * RESULT_CACHE_LOW_WATER
+        evicted_paths = []
+        while self._entries and self._total_bytes > target_bytes:
+            path = next(iter(self._entries))
+            self._total_bytes -= self._entries.pop(path)
+            evicted_paths.append(path)
+        self._evictions += len(evicted_paths)
+        return evicted_paths
+
+    def clear(self):
+        """Deletes every cached entry."""
+        with self._lock:
+            for _, path, _ in self._list_entries():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._entries = {}
+            self._total_bytes = 0
+
+    def stats(self):
+        """
+        Returns:
+            dict: "hits", "misses", "evictions" for this process and the current
+                  on-disk "bytes" used by the cache.
+        """
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "bytes": self._total_bytes,
+            }
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+def get_result_cache():
+    """Returns the process-wide ResultCache, creating it on first use."""
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+            logging.info(f"Result cache at {RESULT_CACHE_DIR} (limit {RESULT_CACHE_MAX_BYTES} bytes).")
+        return _result_cache
+
+
+def configure_result_cache(directory: str = None, max_bytes: int = None):
+    """
+    Points the process-wide result cache at another directory and/or size limit
+    (defaults: RESULT_CACHE_DIR and RESULT_CACHE_MAX_BYTES).
+    """
+    global _result_cache
+    with _result_cache_lock:
+        _result_cache = ResultCache(directory or RESULT_CACHE_DIR, max_bytes or RESULT_CACHE_MAX_BYTES)
+        logging.info(f"Result cache at {_result_cache.directory} (limit {_result_cache.max_bytes} bytes).")
+
+
+def get_cache_stats():
+    """Returns hit/miss/eviction counts and bytes used by the result cache."""
+    return get_result_cache().stats()
+
+
+# --- Local Text Layer Classification ---
+def _is_base_arabic_letter(char: str) -> bool:
+    """
+    True for letters in the Arabic, Arabic Supplement and Arabic Extended-A blocks.
+    Presentation forms (U+FB50-U+FEFF) are deliberately excluded: text layers made
+    of pre-shaped glyphs are usually stored in visual order and read back garbled.
+    """
+    code_point = ord(char)
+    return 0x0600 <= code_point <= 0x06FF or 0x0750 <= code_point <= 0x077F or 0x08A0 <= code_point <= 0x08FF
+
+
+def _is_unmapped_glyph(char: str) -> bool:
+    """
+    True for characters a PDF text layer emits when a glyph has no Unicode mapping:
+    the replacement character, private-use code points and control characters.
+    """
+    code_point = ord(char)
+    if char == "\ufffd" or 0xE000 <= code_point <= 0xF8FF:
+        return True
+    return unicodedata.category(char) == "Cc" and char not in "\n\r\t"
+
+
+def classify_text_layer(page_text: str):
+    """
+    Decides whether a page's embedded text layer is good enough to skip OCR.
+
+    Args:
+        page_text (str): The text PyMuPDF extracted from the page.
+
+    Returns:
+        tuple[bool, float, float]: (usable, arabic_ratio, glyph_coverage) where
+            arabic_ratio is the share of letters that are base Arabic letters and
+            glyph_coverage is the share of visible characters with a real mapping.
+    """
+    visible_chars = [char for char in page_text if not char.isspace()]
+    if len(visible_chars) < TEXT_LAYER_MIN_CHARS:
+        return False, 0.0, 0.0
+
+    letters = [char for char in visible_chars if char.isalpha()]
+    arabic_ratio = sum(1 for char in letters if _is_base_arabic_letter(char)) / len(letters) if letters else 0.0
+    glyph_coverage = 1 - sum(1 for char in visible_chars if _is_unmapped_glyph(char)) / len(visible_chars)
+
+    usable = arabic_ratio >= TEXT_LAYER_MIN_ARABIC_RATIO and glyph_coverage >= TEXT_LAYER_MIN_GLYPH_COVERAGE
+    return usable, arabic_ratio, glyph_coverage
+
+
+def summarize_page_sources(pages: list[dict]):
+    """
+    Summarizes where the text of each page came from.
+
+    Args:
+        pages (list[dict]): Page records as returned by extract_pages_from_pdf.
+
+    Returns:
+        dict: Page counts with keys "total_pages", "text_layer_pages", "vision_pages",
+            "blank_pages" and "duplicate_pages".
+    """
+    return {
+        "total_pages": len(pages),
+        "text_layer_pages": sum(1 for page in pages if page["source"] == "text_layer"),
+        "vision_pages": sum(1 for page in pages if page["source"] == "vision"),
+        "blank_pages": sum(1 for page in pages if page["source"] == "blank"),
+        "duplicate_pages": sum(1 for page in pages if page["source"] == "duplicate"),
+    }
+
+
+# --- Page-Indexed Document Model ---
+PAGE_SEPARATOR = "\n\n" # Between pages in the plain-string form of a document
+# A paragraph is a non-blank line, without its surrounding whitespace (as create_word_document splits text)
+_PARAGRAPH_PATTERN = re.compile(r"[^\S\n]*(\S(?:[^\n]*\S)?)")
+
+
+class TextPage:
+    """
+    One page of a PagedText: where its text sits in the document buffer.
+
+    Attributes:
+        page_number (int): 1-based number of the (first) PDF page.
+        page_count (int): Number of PDF pages covered, more than 1 once Gemini has
+            processed several pages together.
+        source (str): Where the text came from ("text_layer", "vision", "gemini", ...).
+        start (int): Offset of the page's text in the buffer.
+        end (int): Offset just past the page's text (start == end for an empty page).
+    """
+    __slots__ = ("page_number", "page_count", "source", "start", "end")
+
+    def __init__(self, page_number: int, start: int, end: int, source: str = "text", page_count: int = 1):
+        self.page_number = page_number
+        self.page_count = page_count
+        self.source = source
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return f"TextPage(page_number={self.page_number}, page_count={self.page_count}, source={self.source!r}, start={self.start}, end={self.end})"
+
+
+class PagedText:
+    """
+    A document's text as one string buffer plus page and paragraph offsets into it.
+
+    The buffer is exactly the plain-string form used by extract_text_from_pdf and
+    process_text_with_gemini (non-empty pages joined with PAGE_SEPARATOR), so
+    converting to a string copies nothing, and a page or paragraph is only sliced
+    out when it is asked for. Paragraph offsets are found once, on first use, and
+    kept in two compact integer arrays.
+
+    Every backend function that takes a text also takes a PagedText.
+    """
+    __slots__ = ("buffer", "pages", "_paragraph_starts", "_paragraph_ends")
+
+    def __init__(self, buffer: str = "", pages: list = None):
+        self.buffer = buffer
+        self.pages = pages if pages is not None else []
+        self._paragraph_starts = None
+        self._paragraph_ends = None
+
+    @classmethod
+    def from_text(cls, text):
+        """
+        Wraps a plain string, treating each PAGE_SEPARATOR-separated part as a page.
+        A PagedText is returned unchanged and None gives an empty document.
+        """
+        if isinstance(text, PagedText):
+            return text
+        text = text or ""
+        pages = []
+        start = 0
+        while text:
+            end = text.find(PAGE_SEPARATOR, start)
+            if end == -1:
+                pages.append(TextPage(len(pages) + 1, start, len(text)))
+                break
+            pages.append(TextPage(len(pages) + 1, start, end))
+            start = end + len(PAGE_SEPARATOR)
+        return cls(text, pages)
+
+    @classmethod
+    def from_pages(cls, pages: list[dict]):
+        """
+        Builds a document from page records, e.g. those of extract_pages_from_pdf.
+
+        Args:
+            pages (list[dict]): Records with "page_number" and "text", and optionally
+                "source" and "page_count". Pages without text are kept as empty pages
+                but add no separator, so the buffer matches the joined string.
+        """
+        parts = []
+        text_pages = []
+        offset = 0
+        for page in pages:
+            text = page["text"]
+            if text:
+                if parts:
+                    parts.append(PAGE_SEPARATOR)
+                    offset += len(PAGE_SEPARATOR)
+                parts.append(text)
+            text_pages.append(TextPage(page["page_number"], offset, offset + len(text),
+                                       page.get("source", "text"), page.get("page_count", 1)))
+            offset += len(text)
+        return cls("".join(parts), text_pages)
+
+    def to_text(self) -> str:
+        """Returns the plain-string form of the document (the buffer itself, not a copy)."""
+        return self.buffer
+
+    __str__ = to_text
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def __repr__(self):
+        return f"PagedText({len(self.pages)} page(s), {len(self.buffer)} chars)"
+
+    def page_text(self, index: int) -> str:
+        """Returns the text of the page at a 0-based position in pages."""
+        page = self.pages[index]
+        return self.buffer[page.start:page.end]
+
+    def iter_page_texts(self):
+        """Yields (TextPage, text) for every page, in order."""
+        for page in self.pages:
+            yield page, self.buffer[page.start:page.end]
+
+    def _index_paragraphs(self):
+        """Finds the offsets of every paragraph in the buffer, once."""
+        if self._paragraph_starts is None:
+            starts, ends = array("q"), array("q")
+            for match in _PARAGRAPH_PATTERN.finditer(self.buffer):
+                starts.append(match.start(1))
+                ends.append(match.end(1))
+            self._paragraph_starts, self._paragraph_ends = starts, ends
+
+    @property
+    def paragraph_count(self) -> int:
+        """Number of paragraphs (non-blank lines) in the document."""
+        self._index_paragraphs()
+        return len(self._paragraph_starts)
+
+    def iter_paragraphs(self, page_index: int = None):
+        """
+        Yields the paragraphs of the document, or of one page, as stripped strings.
+        These are exactly the paragraphs create_word_document makes of the text.
+        """
+        self._index_paragraphs()
+        first, last = 0, len(self._paragraph_starts)
+        if page_index is not None:
+            page = self.pages[page_index]
+            first = bisect_left(self._paragraph_starts, page.start)
+            last = bisect_left(self._paragraph_starts, page.end)
+        for position in range(first, last):
+            yield self.buffer[self._paragraph_starts[position]:self._paragraph_ends[position]]
+
+
+def _plain_text(text) -> str:
+    """Returns the plain-string form of a str or PagedText (None becomes "")."""
+    if isinstance(text, PagedText):
+        return text.buffer
+    return text or ""
+
+
+# --- Scan Preprocessing and Page De-duplication ---
+# Translation table mapping ink pixels to 1 and paper to 0, so ink can be counted with bytes.count
+_INK_TABLE = bytes(1 if level < PREPROCESS_INK_THRESHOLD else 0 for level in range(256))
+
+
+class _PreprocessStats:
+    """Process-wide counters of the work the preprocessing stage saved."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ["pages_analysed", "blank_pages", "duplicate_pages", "bytes_original", "bytes_sent"], 0
+        )
+
+    def add(self, **amounts):
+        with self._lock:
+            for counter, amount in amounts.items():
+                self._counters[counter] += amount
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["pages_saved"] = stats["blank_pages"] + stats["duplicate_pages"]
+        stats["bytes_saved"] = stats["bytes_original"] - stats["bytes_sent"]
+        return stats
+
+
+_preprocess_stats = _PreprocessStats()
+
+# (dHash, content digest) -> OCR text of pages already read, shared across files (least recently used evicted).
+# The dHash alone only nominates a candidate: sparse pages ("Chapter 2" / "Chapter 3") often share
+# one, so text is only reused for a page whose content digest (see _page_content_digest) matches too.
+_page_hash_index = {}
+_page_hash_index_lock = threading.Lock()
+
+
+def get_preprocess_stats():
+    """
+    Returns what preprocessing saved so far in this process: "pages_analysed",
+    "blank_pages", "duplicate_pages", "pages_saved", and the Vision upload sizes
+    "bytes_original" (as the PDF pages) vs "bytes_sent" and "bytes_saved".
+    """
+    return _preprocess_stats.snapshot()
+
+
+def _lookup_page_hash(page_key: tuple):
+    with _page_hash_index_lock:
+        page_text = _page_hash_index.pop(page_key, None)
+        if page_text is not None:
+            _page_hash_index[page_key] = page_text # Re-insert as most recently used
+        return page_text
+
+
+def _remember_page_hash(page_key: tuple, page_text: str):
+    with _page_hash_index_lock:
+        _page_hash_index.pop(page_key, None)
+        _page_hash_index[page_key] = page_text
+        while len(_page_hash_index) > PREPROCESS_HASH_INDEX_SIZE:
+            del _page_hash_index[next(iter(_page_hash_index))]
+
+
+def _analyse_pixmap(pixmap):
+    """(is_blank, dhash) of a grayscale pixmap rendered at PREPROCESS_ANALYSIS_DPI (see analyse_page)."""
+    ink_pixels = pixmap.samples.translate(_INK_TABLE).count(1)
+    is_blank = ink_pixels < PREPROCESS_BLANK_MAX_INK_RATIO * pixmap.width * pixmap.height
+
+    hash_pixmap = pymupdf.Pixmap(pixmap, PREPROCESS_HASH_SIZE + 1, PREPROCESS_HASH_SIZE, None) # Scaled copy
+    samples, stride = hash_pixmap.samples, hash_pixmap.stride
+    bits = 0
+    for row in range(PREPROCESS_HASH_SIZE):
+        offset = row * stride
+        for column in range(PREPROCESS_HASH_SIZE):
+            bits = (bits << 1) | (samples[offset + column] > samples[offset + column + 1])
+    return is_blank, f"{bits:0{PREPROCESS_HASH_SIZE * PREPROCESS_HASH_SIZE // 4}x}"
+
+
+def analyse_page(page):
+    """
+    Renders a page at PREPROCESS_ANALYSIS_DPI in grayscale and measures it.
+
+    Args:
+        page: A PyMuPDF page.
+
+    Returns:
+        tuple[bool, str]: (is_blank, dhash). dhash is the hex difference hash of the
+            page scaled to a PREPROCESS_HASH_SIZE grid: near-identical renders of the
+            same page (a repeated cover or separator) get the same hash.
+    """
+    return _analyse_pixmap(page.get_pixmap(dpi=PREPROCESS_ANALYSIS_DPI, colorspace=pymupdf.csGRAY, alpha=False))
+
+
+def _is_oversized_scan(page, target_dpi: int) -> bool:
+    """True if an image on the page is stored well above target_dpi (worth re-rendering)."""
+    for image_info in page.get_image_info():
+        shown_width_inches = (image_info["bbox"][2] - image_info["bbox"][0]) / 72
+        if shown_width_inches > 0 and image_info["width"] / shown_width_inches > target_dpi * PREPROCESS_OVERSIZE_FACTOR:
+            return True
+    return False
+
+
+def _page_content_digest(pdf_doc, page, object_digests: dict) -> str:
+    """
+    SHA-256 over everything that draws a page: its size and rotation, its content
+    streams, and the raw streams of the images, form XObjects and embedded fonts it
+    uses (with the names the content refers to them by). Pages with the same digest
+    are byte-identical as drawn, whichever file they come from.
+
+    object_digests caches the digests of shared objects of pdf_doc by xref.
+    """
+    def object_digest(kind: str, xref: int) -> bytes:
+        if (kind, xref) not in object_digests:
+            if kind == "font":
+                data = pdf_doc.extract_font(xref)[3] or b""
+            else:
+                data = pdf_doc.xref_stream_raw(xref) or b""
+            object_digests[(kind, xref)] = hashlib.sha256(data).digest()
+        return object_digests[(kind, xref)]
+
+    digest = hashlib.sha256(f"{tuple(page.rect)}:{page.rotation}".encode())
+    digest.update(page.read_contents())
+    for xref, _, width, height, bpc, colorspace, _, name, image_filter, _ in page.get_images(full=True):
+        digest.update(f"image:{name}:{width}x{height}:{bpc}:{colorspace}:{image_filter}".encode())
+        digest.update(object_digest("image", xref))
+    for xref, name, _, bbox in page.get_xobjects():
+        digest.update(f"xobject:{name}:{tuple(bbox)}".encode())
+        digest.update(object_digest("xobject", xref))
+    for xref, extension, font_type, base_font, name, encoding, *_ in page.get_fonts(full=True):
+        digest.update(f"font:{name}:{base_font}:{font_type}:{extension}:{encoding}".encode())
+        if xref > 0:
+            digest.update(object_digest("font", xref))
+    return digest.hexdigest()
+
+
+def _preprocess_vision_pages(pdf_doc, pdf_lock, pages: list[dict], page_indexes: list[int], duplicate_of: dict,
+                             page_keys: dict, rendered_pages: dict, render_dpi: int = PREPROCESS_TARGET_DPI):
+    """
+    Skips blank and repeated pages among those bound for Vision, and re-renders
+    oversized scans at render_dpi.
+
+    A generator, so the caller can send the first pages to Vision while later ones
+    are still being analysed. Each page is decoded only once, under pdf_lock:
+    oversized scans are rendered at render_dpi and that render is scaled down for
+    the analysis. Blank pages get source "blank". A page counts as repeated only if
+    both its dHash and its content digest match an earlier page, i.e. it is the same
+    page byte for byte; it gets source "duplicate" (and the text, if it was read in
+    an earlier file). Re-scans of a page are not byte-identical and are OCR'd again.
+
+    Args:
+        pdf_doc: The open PDF document.
+        pdf_lock (threading.Lock): Serializes access to pdf_doc.
+        pages (list[dict]): Page records, updated in place.
+        page_indexes (list[int]): 0-based indexes of the pages bound for Vision.
+        duplicate_of (dict): Filled with {page index: index of the identical page
+            OCR'd in this file}.
+        page_keys (dict): Filled with {page index: (dHash, content digest)} for the
+            pages to OCR.
+        rendered_pages (dict): Filled with {page index: JPEG bytes} for re-rendered
+            pages to OCR. They stay in memory until the file is done (about 250 KB
+            per page at 200 dpi).
+        render_dpi (int): Target resolution for oversized scans; None to keep them.
+
+    Yields:
+        int: The index of each page that still has to be OCR'd.
+    """
+    first_page_by_key, object_digests = {}, {}
+    blank_pages = duplicate_pages = 0
+    for page_index in page_indexes:
+        with pdf_lock, span("preprocess", pages=1) as preprocess_span:
+            page = pdf_doc[page_index]
+            rendered_pixmap = None
+            if render_dpi and _is_oversized_scan(page, render_dpi):
+                rendered_pixmap = page.get_pixmap(dpi=render_dpi, colorspace=pymupdf.csGRAY, alpha=False)
+                scale = PREPROCESS_ANALYSIS_DPI / render_dpi
+                analysis_pixmap = pymupdf.Pixmap(rendered_pixmap, max(1, round(rendered_pixmap.width * scale)),
+                                                 max(1, round(rendered_pixmap.height * scale)), None)
+            else:
+                analysis_pixmap = page.get_pixmap(dpi=PREPROCESS_ANALYSIS_DPI, colorspace=pymupdf.csGRAY, alpha=False)
+            is_blank, page_hash = _analyse_pixmap(analysis_pixmap)
+            if not is_blank:
+                page_key = (page_hash, _page_content_digest(pdf_doc, page, object_digests))
+            if not is_blank and rendered_pixmap is not None:
+                rendered_pages[page_index] = rendered_pixmap.tobytes("jpeg", jpg_quality=PREPROCESS_JPEG_QUALITY)
+                preprocess_span["bytes"] = len(rendered_pages[page_index])
+
+        if is_blank:
+            pages[page_index]["source"] = "blank"
+            blank_pages += 1
+            continue
+        known_text = _lookup_page_hash(page_key)
+        if known_text is not None or page_key in first_page_by_key:
+            pages[page_index]["source"] = "duplicate"
+            duplicate_pages += 1
+            rendered_pages.pop(page_index, None)
+            if known_text is not None:
+                pages[page_index]["text"] = known_text
+            else:
+                duplicate_of[page_index] = first_page_by_key[page_key]
+            continue
+        first_page_by_key[page_key] = page_index
+        page_keys[page_index] = page_key
+        yield page_index
+
+    _preprocess_stats.add(pages_analysed=len(page_indexes), blank_pages=blank_pages, duplicate_pages=duplicate_pages)
+    logging.info(
+        f"Preprocessing skipped {blank_pages} blank and {duplicate_pages} duplicate page(s) of {len(page_indexes)}; "
+        f"re-rendered {len(rendered_pages)} oversized scan(s) at {render_dpi} dpi."
+    )
+
+
+def _build_range_pdf(pdf_doc, page_indexes: list[int], rendered_pages: dict = None) -> bytes:
+    """
+    Copies the given pages into a standalone PDF. Pages in rendered_pages are
+    replaced by their re-rendered JPEG, keeping the page size.
+    """
+    rendered_pages = rendered_pages or {}
+    range_doc = pymupdf.open()
+    try:
+        for page_index in page_indexes:
+            if page_index in rendered_pages:
+                page_rect = pdf_doc[page_index].rect
+                rendered_page = range_doc.new_page(width=page_rect.width, height=page_rect.height)
+                rendered_page.insert_image(rendered_page.rect, stream=rendered_pages[page_index])
+            else:
+                range_doc.insert_pdf(pdf_doc, from_page=page_index, to_page=page_index)
+        return range_doc.tobytes()
+    finally:
+        range_doc.close()
+
+
+# --- PDF/Image Processing with Google Cloud Vision ---
+def _annotate_pdf_pages(client, pdf_doc, pdf_lock, page_indexes: list[int], rendered_pages: dict = None):
+    """
+    Sends a group of pages of an open PDF to the Vision API.
+
+    The pages are copied into a small standalone PDF so each request only uploads
+    its own pages, and the request selects those pages explicitly.
+
+    Args:
+        client: The Vision ImageAnnotatorClient to use.
+        pdf_doc: The open PyMuPDF document.
+        pdf_lock (threading.Lock): Guards pdf_doc, since PyMuPDF is not thread-safe.
+        page_indexes (list[int]): The 0-based pages to annotate.
+        rendered_pages (dict, optional): Re-rendered JPEGs by page index (see
+            _preprocess_vision_pages). If any of these pages is in the group, the
+            smaller of the original and the re-rendered upload is sent.
+
+    Returns:
+        list[str | None]: The text of each requested page, "" where Vision found
+            none and None where Vision reported an error for that page.
+
+    Raises:
+        RuntimeError: If the Vision API reports a file-level error or no response.
+    """
+    with pdf_lock, span("vision_split", pages=len(page_indexes)) as split_span:
+        range_content = _build_range_pdf(pdf_doc, page_indexes)
+        if rendered_pages and any(page_index in rendered_pages for page_index in page_indexes):
+            rendered_content = _build_range_pdf(pdf_doc, page_indexes, rendered_pages)
+            _preprocess_stats.add(bytes_original=len(range_content), bytes_sent=min(len(range_content), len(rendered_content)))
+            if len(rendered_content) < len(range_content):
+                range_content = rendered_content
+        split_span["bytes"] = len(range_content)
+
+    page_label = f"{page_indexes[0] + 1}-{page_indexes[-1] + 1}"
+    input_config = vision.InputConfig(content=range_content, mime_type="application/pdf")
+    features = [vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)]
+    image_context = vision.ImageContext(language_hints=["ar"])
+    request = vision.AnnotateFileRequest(
+        input_config=input_config, features=features, image_context=image_context,
+        pages=list(range(1, len(page_indexes) + 1)) # Vision page numbers are 1-based
+    )
+
+    def send_request():
+        response = client.batch_annotate_files(requests=[request])
+        if not response.responses:
+            raise RuntimeError(f"Vision API returned no response for pages {page_label}.")
+        file_response = response.responses[0]
+        if file_response.error.message:
+            error_class = RetryableAPIError if file_response.error.code in _RETRYABLE_STATUS_CODES else RuntimeError
+            raise error_class(f"Vision API Error for pages {page_label}: {file_response.error.message}")
+        return file_response
+
+    logging.info(f"Sending pages {page_label} to Google Cloud Vision API ({len(range_content)} bytes)...")
+    with span("vision_request", bytes=len(range_content), pages=len(page_indexes)):
+        file_response = _call_with_retries("vision", "vision", send_request, requests=len(page_indexes))
+
+    with span("vision_parse", pages=len(page_indexes)) as parse_span:
+        page_texts = [""] * len(page_indexes)
+        for offset, page_response in enumerate(file_response.responses[:len(page_indexes)]):
+            if page_response.error.message:
+                logging.warning(f"  > Vision API Error for page {page_indexes[offset] + 1}: {page_response.error.message}")
+                page_texts[offset] = None
+                parse_span["error"] = True
+                continue
+            if page_response.full_text_annotation:
+                page_texts[offset] = page_response.full_text_annotation.text
+        parse_span["chars"] = sum(len(page_text) for page_text in page_texts if page_text)
+    return page_texts
 
-# --- NEW: Import docxcompose ---
-from docxcompose.composer import Composer
 
-# --- Configure Logging ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(module)s - %(message)s')
+def _check_vision_credentials():
+    """
+    Verifies Vision credentials are available, resolving them on first use.
+
+    Returns:
+        str | None: None if credentials look fine, otherwise an "Error:" string.
+    """
+    if _client_registry.vision_override is not None:
+        return None
+    _, credentials_error = _resolve_vision_credentials()
+    return credentials_error
+
+
+def extract_pages_from_pdf(pdf_file_obj, use_text_layer: bool = True, use_cache: bool = True, preprocess: bool = None):
+    """
+    Extracts the text of every page of a PDF, recording where each page's text came from.
 
-# --- START: Runtime Credentials Setup for Streamlit Cloud (Unchanged) ---
-# (Keep the existing credentials setup block exactly as it was)
-# Define the path for the temporary credentials file within the container's filesystem
-CREDENTIALS_FILENAME = "google_credentials.json"
-_credentials_configured = False # Flag to track if setup was attempted
+    When use_text_layer is True, each page's embedded text layer is checked with
+    classify_text_layer and used directly if it is good enough. The remaining
+    (image-only or badly encoded) pages are sent to Google Cloud Vision in groups
+    of VISION_PAGES_PER_REQUEST pages, at most VISION_MAX_CONCURRENCY at a time.
+
+    With preprocess, those pages are analysed first (see analyse_page): blank pages
+    are skipped, pages identical to one already read in this or an earlier file
+    reuse its text, and the rest are uploaded re-rendered at PREPROCESS_TARGET_DPI
+    when that is smaller than the original pages.
+
+    Results are cached by the SHA-256 of the PDF bytes, so an unchanged PDF is
+    never OCR'd twice. Results with page-level Vision errors are not cached.
+
+    Args:
+        pdf_file_obj: A path to the PDF or a file-like object representing it. Neither
+            is copied into memory (see _open_pdf_source).
+        use_text_layer (bool): Whether to use usable embedded text instead of OCR.
+        use_cache (bool): Whether to read and write the persistent result cache.
+        preprocess (bool, optional): Whether to preprocess pages before OCR.
+            Defaults to PREPROCESS_ENABLED.
 
-if "GOOGLE_CREDENTIALS_JSON" in st.secrets:
-    logging.info("Found GOOGLE_CREDENTIALS_JSON in Streamlit Secrets. Setting up credentials file.")
+    Returns:
+        list[dict]: One record per page, in page order, with keys "page_number"
+            (1-based), "source" ("text_layer", "vision", "blank" or "duplicate") and "text".
+            Returns an empty list if the PDF is empty or has no pages.
+            Returns an error string starting with "Error:" if a critical failure occurs.
+    """
     try:
-        # 1. Read from secrets and log its representation
-        credentials_json_content_from_secrets = st.secrets["GOOGLE_CREDENTIALS_JSON"]
-        logging.info(f"Read {len(credentials_json_content_from_secrets)} characters from secret.")
-        # Log first 500 chars using repr() to see hidden characters like \n explicitly
-        logging.info(f"REPR of secret content (first 500 chars):\n>>>\n{repr(credentials_json_content_from_secrets[:500])}\n<<<")
-
-        if not credentials_json_content_from_secrets.strip():
-             logging.error("GOOGLE_CREDENTIALS_JSON secret is empty.")
-             _credentials_configured = False
-        else:
-            # 2. Write the file with potential cleaning
-            file_written_successfully = False
-            try:
-                # --- START CLEANING ATTEMPT ---
-                cleaned_content = credentials_json_content_from_secrets
-                try:
-                    # Attempt to parse to find the private key and clean it specifically
-                    temp_data = json.loads(credentials_json_content_from_secrets)
-                    if 'private_key' in temp_data and isinstance(temp_data['private_key'], str):
-                        original_pk = temp_data['private_key']
-                        cleaned_pk = original_pk.replace('\r\n', '\n').replace('\r', '\n').replace('\\n', '\n')
-                        if cleaned_pk != original_pk:
-                           logging.warning("Attempted to clean '\\r' or incorrectly escaped '\\n' characters from private_key string.")
-                           temp_data['private_key'] = cleaned_pk
-                           cleaned_content = json.dumps(temp_data, indent=2)
-                        else:
-                            cleaned_content = credentials_json_content_from_secrets
-                    else:
-                         logging.warning("Could not find 'private_key' field (or it's not a string) in parsed secret data for cleaning.")
-                         cleaned_content = credentials_json_content_from_secrets
-                except json.JSONDecodeError:
-                    logging.warning("Initial parse for targeted cleaning failed. Trying global replace on raw string (less safe).")
-                    cleaned_content = credentials_json_content_from_secrets.replace('\r\n', '\n').replace('\r', '\n').replace('\\n', '\n')
-                # --- END CLEANING ATTEMPT ---
-
-                with open(CREDENTIALS_FILENAME, "w", encoding='utf-8') as f:
-                    f.write(cleaned_content)
-                logging.info(f"Successfully wrote potentially cleaned credentials to {CREDENTIALS_FILENAME} using UTF-8 encoding.")
-                file_written_successfully = True
-            except Exception as write_err:
-                 logging.error(f"CRITICAL Error during file writing (with cleaning attempt): {write_err}", exc_info=True)
-                 _credentials_configured = False # Ensure flag is false on write error
-
-            # 3. If written, read back immediately and verify/parse
-            if file_written_successfully:
-                credentials_content_read_back = None
-                try:
-                    with open(CREDENTIALS_FILENAME, "r", encoding='utf-8') as f:
-                        credentials_content_read_back = f.read()
-                    logging.info(f"Successfully read back {len(credentials_content_read_back)} characters from {CREDENTIALS_FILENAME}.")
-                    logging.info(f"REPR of read-back content (first 500 chars):\n>>>\n{repr(credentials_content_read_back[:500])}\n<<<")
-
-                    # 4. Try parsing the read-back content manually using standard json library
-                    try:
-                        json.loads(credentials_content_read_back)
-                        logging.info("Manual JSON parsing of read-back content SUCCEEDED.")
-                        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = CREDENTIALS_FILENAME
-                        logging.info(f"GOOGLE_APPLICATION_CREDENTIALS set to point to: {CREDENTIALS_FILENAME}")
-                        _credentials_configured = True # Mark configuration as successful ONLY here
-                    except json.JSONDecodeError as parse_err:
-                        logging.error(f"Manual JSON parsing of read-back content FAILED: {parse_err}", exc_info=True)
-                        _credentials_configured = False # Parsing failed
-                    except Exception as manual_parse_generic_err:
-                        logging.error(f"Unexpected error during manual JSON parsing: {manual_parse_generic_err}", exc_info=True)
-                        _credentials_configured = False
-
-                except Exception as read_err:
-                    logging.error(f"CRITICAL Error reading back credentials file {CREDENTIALS_FILENAME}: {read_err}", exc_info=True)
-                    _credentials_configured = False
+        try:
+            pdf_doc, content_hash, file_size = _open_pdf_source(pdf_file_obj)
+        except Exception as open_err:
+            logging.error(f"Could not open PDF with PyMuPDF: {open_err}", exc_info=True)
+            return f"Error: Failed to read PDF. Exception: {open_err}"
+
+        if pdf_doc is None:
+            logging.warning("PDF content is empty.")
+            return []
+
+        preprocess = PREPROCESS_ENABLED if preprocess is None else preprocess
+        # "-preprocessed2": results cached before duplicates needed a content digest match may hold misattributed text
+        cache_key = f"{content_hash}-{'text_layer' if use_text_layer else 'vision_only'}{'-preprocessed2' if preprocess else ''}"
+        if use_cache:
+            cached_pages = get_result_cache().get("ocr", cache_key)
+            if cached_pages is not None:
+                logging.info(f"Using cached OCR result for PDF {cache_key[:12]}.")
+                pdf_doc.close()
+                return json.loads(cached_pages)
+
+        try:
+            pages = []
+            vision_page_indexes = []
+            had_page_errors = False
+            with span("text_layer", bytes=file_size, pages=pdf_doc.page_count) as text_layer_span:
+                for page_index, page in enumerate(pdf_doc):
+                    if use_text_layer:
+                        page_text = page.get_text("text")
+                        usable, arabic_ratio, glyph_coverage = classify_text_layer(page_text)
+                        if usable:
+                            pages.append({"page_number": page_index + 1, "source": "text_layer", "text": page_text.strip()})
+                            continue
+                    pages.append({"page_number": page_index + 1, "source": "vision", "text": ""})
+                    vision_page_indexes.append(page_index)
+                text_layer_span["chars"] = sum(len(page["text"]) for page in pages)
+
+            duplicate_of, page_keys, rendered_pages = {}, {}, {}
+            if vision_page_indexes:
+                credentials_error = _check_vision_credentials()
+                if credentials_error:
+                    return credentials_error
+
+                client = get_vision_client()
+                pdf_lock = threading.Lock()
+                if preprocess:
+                    ocr_page_indexes = _preprocess_vision_pages(pdf_doc, pdf_lock, pages, vision_page_indexes,
+                                                                duplicate_of, page_keys, rendered_pages)
+                else:
+                    ocr_page_indexes = iter(vision_page_indexes)
+
+                logging.info(f"Sending up to {len(vision_page_indexes)} of {pdf_doc.page_count} page(s) to Vision API...")
+                max_workers = min(VISION_MAX_CONCURRENCY, -(-len(vision_page_indexes) // VISION_PAGES_PER_REQUEST))
+                page_groups, futures = [], []
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    def submit_group(page_group):
+                        page_groups.append(page_group)
+                        futures.append(_submit_in_context(executor, _annotate_pdf_pages, client, pdf_doc, pdf_lock,
+                                                          page_group, rendered_pages))
+
+                    # Groups are submitted as soon as they fill up, so OCR overlaps preprocessing
+                    page_group = []
+                    for page_index in ocr_page_indexes:
+                        page_group.append(page_index)
+                        if len(page_group) == VISION_PAGES_PER_REQUEST:
+                            submit_group(page_group)
+                            page_group = []
+                    if page_group:
+                        submit_group(page_group)
+                    # Collect in submission order so pages stay in document order
+                    group_results = [future.result() for future in futures]
+                logging.info(f"Received all responses from Vision API ({len(page_groups)} request(s)).")
+
+                for page_group, page_texts in zip(page_groups, group_results):
+                    for page_index, page_text in zip(page_group, page_texts):
+                        if page_text is None:
+                            had_page_errors = True
+                            continue
+                        pages[page_index]["text"] = page_text
+                        if page_index in page_keys:
+                            _remember_page_hash(page_keys[page_index], page_text)
+
+            for page_index, original_page_index in duplicate_of.items():
+                pages[page_index]["text"] = pages[original_page_index]["text"]
+        finally:
+            pdf_doc.close()
+
+        source_summary = summarize_page_sources(pages)
+        logging.info(
+            f"Page sources: {source_summary['text_layer_pages']} from text layer, {source_summary['vision_pages']} via Vision OCR, "
+            f"{source_summary['blank_pages']} blank, {source_summary['duplicate_pages']} duplicate (of {source_summary['total_pages']})."
+        )
+        if use_cache and not had_page_errors:
+            get_result_cache().put("ocr", cache_key, json.dumps(pages, ensure_ascii=False))
+        return pages
 
     except Exception as e:
-        logging.error(f"CRITICAL Error reading secret: {e}", exc_info=True)
-        _credentials_configured = False
-
-elif "GOOGLE_APPLICATION_CREDENTIALS" in os.environ:
-    logging.info("Using GOOGLE_APPLICATION_CREDENTIALS environment variable set externally.")
-    if os.environ.get("GOOGLE_APPLICATION_CREDENTIALS") and os.path.exists(os.environ["GOOGLE_APPLICATION_CREDENTIALS"]):
-        logging.info(f"External credentials file found at: {os.environ['GOOGLE_APPLICATION_CREDENTIALS']}")
-        _credentials_configured = True
-    else:
-        logging.error(f"External GOOGLE_APPLICATION_CREDENTIALS path not found or not set: {os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')}")
-        _credentials_configured = False
+        logging.error(f"CRITICAL Error during Vision API interaction: {e}", exc_info=True)
+        return f"Error: Failed to process PDF with Vision API. Exception: {e}"
 
-else:
-    logging.warning("Vision API Credentials NOT found: Neither GOOGLE_CREDENTIALS_JSON secret nor GOOGLE_APPLICATION_CREDENTIALS env var is set.")
-    _credentials_configured = False
-# --- END: Runtime Credentials Setup ---
+
+def extract_document_from_pdf(pdf_file_obj, use_text_layer: bool = True, use_cache: bool = True, preprocess: bool = None):
+    """
+    Extracts text from a PDF like extract_text_from_pdf, keeping the page structure.
+
+    Args:
+        pdf_file_obj: A path to the PDF or a file-like object representing it.
+        use_text_layer (bool): Whether to use usable embedded text instead of OCR.
+        use_cache (bool): Whether to read and write the persistent result cache.
+        preprocess (bool, optional): Whether to skip blank and duplicate pages and
+            re-render scans before OCR. Defaults to PREPROCESS_ENABLED.
+    Returns:
+        PagedText: One page per PDF page, with the page's source. Its plain-string form
+                   is what extract_text_from_pdf returns.
+                   Returns an error string starting with "Error:" if a critical failure occurs.
+    """
+    pages = extract_pages_from_pdf(pdf_file_obj, use_text_layer=use_text_layer, use_cache=use_cache, preprocess=preprocess)
+    if isinstance(pages, str):
+        return pages
+    return PagedText.from_pages(pages)
 
 
-# --- PDF/Image Processing with Google Cloud Vision (Unchanged) ---
-def extract_text_from_pdf(pdf_file_obj):
+def extract_text_from_pdf(pdf_file_obj, use_text_layer: bool = True, use_cache: bool = True, preprocess: bool = None):
     """
-    Extracts text from a PDF file object using Google Cloud Vision API OCR.
+    Extracts text from a PDF file object, using the embedded text layer where it is
+    usable and Google Cloud Vision API OCR for the remaining pages.
     Handles both text-based and image-based PDFs.
+
     Args:
-        pdf_file_obj: A file-like object representing the PDF.
+        pdf_file_obj: A path to the PDF or a file-like object representing it.
+        use_text_layer (bool): Whether to use usable embedded text instead of OCR.
+        use_cache (bool): Whether to read and write the persistent result cache.
+        preprocess (bool, optional): Whether to skip blank and duplicate pages and
+            re-render scans before OCR. Defaults to PREPROCESS_ENABLED.
     Returns:
         str: The extracted text, with pages separated by double newlines.
              Returns an empty string "" if no text is found.
              Returns an error string starting with "Error:" if a critical failure occurs.
     """
-    global _credentials_configured
-
-    if not _credentials_configured:
-        logging.error("Vision API credentials were not configured successfully during startup.")
-        return "Error: Vision API authentication failed (Credentials setup failed)."
-
-    credentials_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-    if not credentials_path or not os.path.exists(credentials_path):
-         logging.error(f"Credentials check failed just before client init: GOOGLE_APPLICATION_CREDENTIALS path '{credentials_path}' not valid or file doesn't exist.")
-         return "Error: Vision API credentials file missing or inaccessible at runtime."
-
-    try:
-        logging.info(f"Initializing Google Cloud Vision client using credentials file: {credentials_path}")
-        client = vision.ImageAnnotatorClient()
-        logging.info("Vision client initialized successfully.")
-
-        pdf_file_obj.seek(0)
-        content = pdf_file_obj.read()
-        file_size = len(content)
-        logging.info(f"Read {file_size} bytes from PDF stream.")
+    document = extract_document_from_pdf(pdf_file_obj, use_text_layer=use_text_layer, use_cache=use_cache, preprocess=preprocess)
+    if isinstance(document, str):
+        return document
 
-        if not content:
-            logging.warning("PDF content is empty.")
-            return ""
-
-        mime_type = "application/pdf"
-        input_config = vision.InputConfig(content=content, mime_type=mime_type)
-        features = [vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)]
-        image_context = vision.ImageContext(language_hints=["ar"])
-        request = vision.AnnotateFileRequest(
-            input_config=input_config, features=features, image_context=image_context
-        )
+    extracted_text = document.to_text()
 
-        logging.info("Sending request to Google Cloud Vision API (batch_annotate_files)...")
-        response = client.batch_annotate_files(requests=[request])
-        logging.info("Received response from Vision API.")
+    if extracted_text:
+        text_page_count = sum(1 for page in document.pages if page.end > page.start)
+        logging.info(f"Successfully extracted text from {text_page_count} page(s). Total Length: {len(extracted_text)}")
+        if not extracted_text.strip():
+             logging.warning("Pages were processed, but extracted text is empty/whitespace after combining.")
+             return ""
+        return extracted_text
+    else:
+        logging.warning("No usable text found on any page.")
+        return ""
 
-        if not response.responses:
-            logging.error("Vision API returned an empty response list.")
-            return "Error: Vision API returned no response."
 
-        first_file_response = response.responses[0]
+# --- Gemini Processing (MODIFIED) ---
+def estimate_tokens(text: str) -> int:
+    """
+    Roughly estimates the Gemini token count of a text without an API call.
+    """
+    return -(-len(text) // GEMINI_CHARS_PER_TOKEN) # Ceiling division
 
-        if first_file_response.error.message:
-            error_message = f"Vision API Error for file: {first_file_response.error.message}"
-            logging.error(error_message)
-            return f"Error: {error_message}"
 
-        all_extracted_text = []
-        if not first_file_response.responses:
-             logging.warning("Vision API's AnnotateFileResponse contained an empty inner 'responses' list. No pages processed?")
-             return ""
+def _build_gemini_prompt(rules_prompt: str, raw_text: str) -> str:
+    """Builds the full Gemini prompt from the user's rules and the text to process."""
+    return f"""
+        **Instructions:**
+        {rules_prompt}
 
-        for page_index, page_response in enumerate(first_file_response.responses):
-            if page_response.error.message:
-                logging.warning(f"  > Vision API Error for page {page_index + 1}: {page_response.error.message}")
-                continue
-            if page_response.full_text_annotation:
-                page_text = page_response.full_text_annotation.text
-                all_extracted_text.append(page_text)
-            # else: # Optional logging
-            #    logging.info(f"  > Page {page_index + 1} had no full_text_annotation.")
-
-        extracted_text = "\n\n".join(all_extracted_text)
-
-        if extracted_text:
-            logging.info(f"Successfully extracted text from {len(all_extracted_text)} page(s) using Vision API. Total Length: {len(extracted_text)}")
-            if not extracted_text.strip():
-                 logging.warning("Vision API processed pages, but extracted text is empty/whitespace after combining.")
-                 return ""
-            return extracted_text
-        else:
-            logging.warning("Vision API response received, but no usable full_text_annotation found on any page.")
-            return ""
+        **Arabic Text to Process:**
+        ---
+        {raw_text}
+        ---
 
-    except Exception as e:
-        logging.error(f"CRITICAL Error during Vision API interaction: {e}", exc_info=True)
-        return f"Error: Failed to process PDF with Vision API. Exception: {e}"
+        **Output:**
+        Return ONLY the processed text according to the instructions. Do not add any introductory phrases like "Here is the processed text:". Ensure proper Arabic formatting and right-to-left presentation.
+        """
 
 
-# --- Gemini Processing (MODIFIED) ---
 # --- ADD model_name parameter ---
-def process_text_with_gemini(api_key: str, raw_text: str, rules_prompt: str, model_name: str):
+def process_text_with_gemini(api_key: str, raw_text: str, rules_prompt: str, model_name: str, use_cache: bool = True,
+                             chunk_tokens: int = None, max_workers: int = GEMINI_MAX_CONCURRENCY):
     """
     Processes raw text using the specified Gemini API model based on provided rules.
+    Successful responses are cached by (text hash, rules hash, model name).
+
+    If chunk_tokens is set and the text is estimated to be longer than that, the
+    text is processed in chunks by process_text_with_gemini_chunked and the
+    stitched result is returned. A failed chunk keeps its unprocessed text without
+    an "Error:" marker; call process_text_with_gemini_chunked directly to get the
+    chunk reports (process_batch does).
 
     Args:
         api_key (str): The Gemini API key.
-        raw_text (str): The raw text extracted from the PDF.
+        raw_text (str | PagedText): The raw text extracted from the PDF.
         rules_prompt (str): User-defined rules/instructions for Gemini.
         model_name (str): The specific Gemini model ID to use (e.g., "gemini-1.5-flash-latest").
+        use_cache (bool): Whether to read and write the persistent result cache.
+        chunk_tokens (int, optional): Token budget per Gemini request. None disables chunking.
+        max_workers (int): Max concurrent Gemini requests when chunking.
 
     Returns:
         str: The processed text from Gemini. Returns empty string "" if raw_text is empty.
@@ -229,6 +1842,8 @@ def process_text_with_gemini(api_key: str, raw_text: str, rules_prompt: str, mod
         logging.error("Gemini API key is missing.")
         return "Error: Gemini API key is missing."
 
+    document = raw_text
+    raw_text = _plain_text(raw_text)
     if not raw_text or not raw_text.strip():
         logging.warning("Skipping Gemini call: No raw text provided.")
         return ""
@@ -239,51 +1854,49 @@ def process_text_with_gemini(api_key: str, raw_text: str, rules_prompt: str, mod
         return "Error: Gemini model name not specified."
     # ---
 
-    try:
-        genai.configure(api_key=api_key)
-        # --- Use the PASSED model name ---
-        logging.info(f"Initializing Gemini model: {model_name}")
-        model = genai.GenerativeModel(model_name)
-        # ---                               ---
+    if chunk_tokens and estimate_tokens(raw_text) > chunk_tokens:
+        chunked_result = process_text_with_gemini_chunked(
+            api_key, document, rules_prompt, model_name,
+            chunk_tokens=chunk_tokens, max_workers=max_workers, use_cache=use_cache
+        )
+        return chunked_result["text"]
 
-        full_prompt = f"""
-        **Instructions:**
-        {rules_prompt}
+    cache_key = _sha256_hex(f"{_sha256_hex(raw_text)}:{_sha256_hex(rules_prompt or '')}:{model_name}")
+    if use_cache:
+        cached_text = get_result_cache().get("gemini", cache_key)
+        if cached_text is not None:
+            logging.info(f"Using cached Gemini ({model_name}) result. Processed text length: {len(cached_text)}")
+            return cached_text
 
-        **Arabic Text to Process:**
-        ---
-        {raw_text}
-        ---
+    try:
+        # --- Use the PASSED model name (cached client, no global genai.configure) ---
+        model = get_gemini_model(api_key, model_name)
 
-        **Output:**
-        Return ONLY the processed text according to the instructions. Do not add any introductory phrases like "Here is the processed text:". Ensure proper Arabic formatting and right-to-left presentation.
-        """
+        with span("gemini_prompt_build", chars=len(raw_text)) as prompt_span:
+            full_prompt = _build_gemini_prompt(rules_prompt, raw_text)
+            prompt_span["tokens"] = estimate_tokens(full_prompt)
 
         # --- Update logging to include the model name ---
         logging.info(f"Sending request to Gemini model: {model_name}. Text length: {len(raw_text)}")
         # ---
-        response = model.generate_content(full_prompt)
+        with span("gemini_call", chars=len(full_prompt), tokens=prompt_span["tokens"]):
+            response = _call_with_retries(
+                "gemini", model_name, lambda: model.generate_content(full_prompt),
+                tokens=prompt_span["tokens"]
+            )
 
         # Error handling for response remains the same
-        if not response.parts:
-            block_reason = None
-            safety_ratings = None
-            if hasattr(response, 'prompt_feedback'):
-                 block_reason = getattr(response.prompt_feedback, 'block_reason', None)
-                 safety_ratings = getattr(response.prompt_feedback, 'safety_ratings', None)
-
-            if block_reason:
-                block_reason_msg = f"Content blocked by Gemini safety filters. Reason: {block_reason}"
-                logging.error(f"Gemini request ({model_name}) blocked. Reason: {block_reason}. Ratings: {safety_ratings}")
-                return f"Error: {block_reason_msg}"
-            else:
-                finish_reason_obj = getattr(response, 'prompt_feedback', None)
-                finish_reason = getattr(finish_reason_obj, 'finish_reason', 'UNKNOWN') if finish_reason_obj else 'UNKNOWN'
-                logging.warning(f"Gemini ({model_name}) returned no parts (empty response). Finish Reason: {finish_reason}")
-                return ""
+        with span("gemini_response") as response_span:
+            processed_text = _read_gemini_response(response, model_name)
+            response_span["chars"] = len(processed_text)
+            response_span["tokens"] = estimate_tokens(processed_text)
+            response_span["error"] = processed_text.startswith("Error:")
+        if not processed_text or processed_text.startswith("Error:"):
+            return processed_text
 
-        processed_text = response.text
         logging.info(f"Successfully received response from Gemini ({model_name}). Processed text length: {len(processed_text)}")
+        if use_cache and processed_text:
+            get_result_cache().put("gemini", cache_key, processed_text)
         return processed_text
 
     except Exception as e:
@@ -291,7 +1904,416 @@ def process_text_with_gemini(api_key: str, raw_text: str, rules_prompt: str, mod
         return f"Error: Failed to process text with Gemini ({model_name}). Details: {e}"
 
 
-# --- Create SINGLE Word Document (Unchanged) ---
+def _read_gemini_response(response, model_name: str) -> str:
+    """
+    Returns the text of a generate_content response, "" if it was empty, or an
+    "Error:" string if the prompt was blocked.
+    """
+    if not response.parts:
+        block_reason = None
+        safety_ratings = None
+        if hasattr(response, 'prompt_feedback'):
+             block_reason = getattr(response.prompt_feedback, 'block_reason', None)
+             safety_ratings = getattr(response.prompt_feedback, 'safety_ratings', None)
+
+        if block_reason:
+            block_reason_msg = f"Content blocked by Gemini safety filters. Reason: {block_reason}"
+            logging.error(f"Gemini request ({model_name}) blocked. Reason: {block_reason}. Ratings: {safety_ratings}")
+            return f"Error: {block_reason_msg}"
+        else:
+            finish_reason_obj = getattr(response, 'prompt_feedback', None)
+            finish_reason = getattr(finish_reason_obj, 'finish_reason', 'UNKNOWN') if finish_reason_obj else 'UNKNOWN'
+            logging.warning(f"Gemini ({model_name}) returned no parts (empty response). Finish Reason: {finish_reason}")
+            return ""
+    return response.text
+
+
+# --- Streaming Gemini Processing ---
+def stream_text_with_gemini(api_key: str, raw_text: str, rules_prompt: str, model_name: str, on_partial=None):
+    """
+    Streams Gemini's processed text, yielding each complete line as soon as it arrives.
+
+    Only the current unfinished line is buffered, never the whole response.
+    Streamed results are not cached.
+
+    Args:
+        api_key (str): The Gemini API key.
+        raw_text (str | PagedText): The raw text extracted from the PDF.
+        rules_prompt (str): User-defined rules/instructions for Gemini.
+        model_name (str): The specific Gemini model ID to use.
+        on_partial (callable, optional): Called with every raw text fragment as it
+            arrives, e.g. to show a live preview.
+
+    Yields:
+        str: Complete lines of processed text (without the trailing newline).
+
+    Raises:
+        RuntimeError: If the request fails or the content is blocked.
+    """
+    if not api_key:
+        raise RuntimeError("Gemini API key is missing.")
+    if not model_name:
+        raise RuntimeError("Gemini model name not specified.")
+    raw_text = _plain_text(raw_text)
+    if not raw_text or not raw_text.strip():
+        logging.warning("Skipping Gemini call: No raw text provided.")
+        return
+
+    model = get_gemini_model(api_key, model_name)
+    with span("gemini_prompt_build", chars=len(raw_text)) as prompt_span:
+        full_prompt = _build_gemini_prompt(rules_prompt, raw_text)
+        prompt_span["tokens"] = estimate_tokens(full_prompt)
+    logging.info(f"Streaming request to Gemini model: {model_name}. Text length: {len(raw_text)}")
+    # Only opening the stream is retried; once lines have been yielded they cannot be taken back.
+    # The span covers opening the stream only: time between chunks includes the consumer's work.
+    with span("gemini_call", chars=len(full_prompt), tokens=prompt_span["tokens"]):
+        response = _call_with_retries(
+            "gemini", model_name, lambda: model.generate_content(full_prompt, stream=True),
+            tokens=prompt_span["tokens"]
+        )
+
+    pending_line = ""
+    streamed_chars = 0
+    for chunk in response:
+        if not chunk.parts:
+            continue
+        fragment = chunk.text
+        streamed_chars += len(fragment)
+        if on_partial:
+            on_partial(fragment)
+        *complete_lines, pending_line = (pending_line + fragment).split("\n")
+        yield from complete_lines
+
+    block_reason = getattr(getattr(response, 'prompt_feedback', None), 'block_reason', None)
+    if block_reason and not streamed_chars:
+        logging.error(f"Gemini streaming request ({model_name}) blocked. Reason: {block_reason}")
+        raise RuntimeError(f"Content blocked by Gemini safety filters. Reason: {block_reason}")
+    if pending_line:
+        yield pending_line
+    logging.info(f"Finished streaming response from Gemini ({model_name}). Processed text length: {streamed_chars}")
+
+
+def process_text_with_gemini_to_document(api_key: str, raw_text: str, rules_prompt: str, model_name: str, on_partial=None):
+    """
+    Streams Gemini's output straight into a Word document, paragraph by paragraph.
+
+    Args:
+        api_key (str): The Gemini API key.
+        raw_text (str | PagedText): The raw text extracted from the PDF.
+        rules_prompt (str): User-defined rules/instructions for Gemini.
+        model_name (str): The specific Gemini model ID to use.
+        on_partial (callable, optional): Called with every raw text fragment as it arrives.
+
+    Returns:
+        file-like: The Word document data from new_document_buffer (with the placeholder
+                   if there was no output).
+                    Returns an error string starting with "Error:" if a failure occurs.
+    """
+    writer = StreamingDocumentWriter()
+    try:
+        for line in stream_text_with_gemini(api_key, raw_text, rules_prompt, model_name, on_partial=on_partial):
+            writer.add_line(line)
+        return writer.finish()
+    except Exception as e:
+        logging.error(f"Error streaming from Gemini API ({model_name}): {e}", exc_info=True)
+        return f"Error: Failed to stream text from Gemini ({model_name}). Details: {e}"
+
+
+# --- Chunked Gemini Processing ---
+def _split_oversized_page(page: str, max_chars: int):
+    """
+    Splits a page longer than max_chars into pieces on line boundaries, falling
+    back to word boundaries for single lines that are still too long.
+    """
+    pieces = []
+    for line in page.split("\n"):
+        if len(line) <= max_chars:
+            pieces.append(line)
+            continue
+        current_words = []
+        current_length = 0
+        for word in line.split(" "):
+            if current_words and current_length + 1 + len(word) > max_chars:
+                pieces.append(" ".join(current_words))
+                current_words = []
+                current_length = 0
+            current_length += len(word) + (1 if current_words else 0)
+            current_words.append(word)
+        if current_words:
+            pieces.append(" ".join(current_words))
+    return pieces
+
+
+def _group_pages(document: PagedText, max_chars: int):
+    """
+    Groups the consecutive non-empty pages of a document into runs whose text (a
+    single slice of the buffer) is at most max_chars long. A page longer than
+    that forms a run of its own.
+
+    Returns:
+        list[list[TextPage]]: The runs, in order.
+    """
+    groups = []
+    for page in document.pages:
+        if page.end == page.start:
+            continue
+        if groups and page.end - groups[-1][0].start <= max_chars:
+            groups[-1].append(page)
+        else:
+            groups.append([page])
+    return groups
+
+
+def split_text_into_chunks(raw_text, max_tokens: int):
+    """
+    Splits text into chunks of at most max_tokens (estimated), keeping pages
+    (separated by blank lines) and then lines together wherever possible.
+
+    The chunks depend only on the text: a PagedText is split like its plain
+    string, on every blank line of its buffer rather than on its page offsets.
+    So a text gives the same chunks, and hits the same Gemini cache entries,
+    whether it comes straight from OCR or back from a job checkpoint.
+
+    Args:
+        raw_text (str | PagedText): The text to split, pages separated by double
+            newlines.
+        max_tokens (int): The estimated token budget per chunk.
+
+    Returns:
+        list[str]: The chunks, in order, each one slice of the text unless a single
+                   page is too long. Joining them with "\n\n" gives back the text,
+                   apart from oversized pages being re-broken on lines.
+    """
+    max_chars = max(1, max_tokens * GEMINI_CHARS_PER_TOKEN)
+    blocks = PagedText.from_text(_plain_text(raw_text)) # Offsets of the blank-line separated parts, no copy
+    chunks = []
+    for group in _group_pages(blocks, max_chars):
+        if group[-1].end - group[0].start <= max_chars:
+            chunks.append(blocks.buffer[group[0].start:group[-1].end])
+            continue
+        # A single page longer than max_chars: pack its lines (or words) instead
+        current = ""
+        for piece in _split_oversized_page(blocks.buffer[group[0].start:group[0].end], max_chars):
+            if current and len(current) + 1 + len(piece) > max_chars:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current}\n{piece}" if current else piece
+        if current:
+            chunks.append(current)
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def _process_chunks_with_gemini(chunks: list[str], api_key: str, rules_prompt: str, model_name: str,
+                                max_workers: int, use_cache: bool):
+    """
+    Sends each chunk through process_text_with_gemini with a pool of at most
+    max_workers threads.
+
+    Returns:
+        list[tuple]: (result, report) per chunk, in order, where report has "index",
+            "chars", "estimated_tokens", "seconds" and "error" (None on success).
+    """
+    def process_chunk(index: int, chunk: str):
+        start_time = time.perf_counter()
+        try:
+            result = process_text_with_gemini(api_key, chunk, rules_prompt, model_name, use_cache=use_cache)
+        except Exception as e: # process_text_with_gemini should not raise, but never lose the chunk
+            result = f"Error: {e}"
+        report = {
+            "index": index,
+            "chars": len(chunk),
+            "estimated_tokens": estimate_tokens(chunk),
+            "seconds": time.perf_counter() - start_time,
+            "error": result if result.startswith("Error:") else None,
+        }
+        return result, report
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+        futures = [_submit_in_context(executor, process_chunk, index, chunk) for index, chunk in enumerate(chunks)]
+        return [future.result() for future in futures]
+
+
+def process_text_with_gemini_chunked(api_key: str, raw_text, rules_prompt: str, model_name: str,
+                                     chunk_tokens: int = GEMINI_DEFAULT_CHUNK_TOKENS,
+                                     max_workers: int = GEMINI_MAX_CONCURRENCY, use_cache: bool = True):
+    """
+    Processes a long text with Gemini in chunks, concurrently, and stitches the results.
+
+    The text is split with split_text_into_chunks and each chunk is sent through
+    process_text_with_gemini by a pool of at most max_workers threads. A failed
+    chunk does not fail the document: its original text is kept in place so no
+    content is lost, and the failure is reported in the chunk list.
+
+    Args:
+        api_key (str): The Gemini API key.
+        raw_text (str | PagedText): The raw text extracted from the PDF.
+        rules_prompt (str): User-defined rules/instructions for Gemini.
+        model_name (str): The specific Gemini model ID to use.
+        chunk_tokens (int): The estimated token budget per chunk.
+        max_workers (int): Max concurrent Gemini requests.
+        use_cache (bool): Whether to read and write the persistent result cache.
+
+    Returns:
+        dict: {"text": str, "chunks": list[dict], "failed_chunks": int} where each
+              chunk report has "index", "chars", "estimated_tokens", "seconds" and
+              "error" (None on success). "text" is an "Error:" string only if every
+              chunk failed.
+    """
+    chunks = split_text_into_chunks(raw_text, chunk_tokens)
+    if not chunks:
+        return {"text": "", "chunks": [], "failed_chunks": 0}
+
+    logging.info(f"Processing text with Gemini ({model_name}) in {len(chunks)} chunk(s) of up to ~{chunk_tokens} tokens, {max_workers} at a time.")
+    results = _process_chunks_with_gemini(chunks, api_key, rules_prompt, model_name, max_workers, use_cache)
+
+    stitched_parts = []
+    chunk_reports = []
+    for chunk, (result, report) in zip(chunks, results):
+        chunk_reports.append(report)
+        if report["error"]:
+            logging.warning(f"Gemini chunk {report['index'] + 1}/{len(chunks)} failed, keeping its original text: {report['error']}")
+            stitched_parts.append(chunk)
+        elif result:
+            stitched_parts.append(result)
+
+    failed_chunks = sum(1 for report in chunk_reports if report["error"])
+    if failed_chunks == len(chunks):
+        logging.error(f"All {len(chunks)} Gemini chunk(s) failed for model {model_name}.")
+        return {"text": chunk_reports[0]["error"], "chunks": chunk_reports, "failed_chunks": failed_chunks}
+
+    logging.info(f"Stitched {len(chunks)} Gemini chunk(s) ({failed_chunks} failed) in {max(report['seconds'] for report in chunk_reports):.1f}s (slowest chunk).")
+    return {"text": "\n\n".join(stitched_parts), "chunks": chunk_reports, "failed_chunks": failed_chunks}
+
+
+def process_document_with_gemini(api_key: str, document, rules_prompt: str, model_name: str,
+                                 chunk_tokens: int = GEMINI_DEFAULT_CHUNK_TOKENS,
+                                 max_workers: int = GEMINI_MAX_CONCURRENCY, use_cache: bool = True):
+    """
+    Processes a document with Gemini page by page, keeping the page structure.
+
+    Consecutive pages are sent together, as one slice of the buffer, up to
+    chunk_tokens; a longer page is split with split_text_into_chunks and its
+    chunks are stitched back like process_text_with_gemini_chunked does. Every
+    request is cached separately, so re-running a document only pays for the
+    runs that changed or failed. A failed request keeps its original text: a run
+    whose requests all failed is marked with source "original", one where only
+    some failed with source "partial", so the caller can retry just those pages.
+
+    Args:
+        api_key (str): The Gemini API key.
+        document (PagedText | str): The raw text, e.g. from extract_document_from_pdf.
+        rules_prompt (str): User-defined rules/instructions for Gemini.
+        model_name (str): The specific Gemini model ID to use.
+        chunk_tokens (int): The estimated token budget per request.
+        max_workers (int): Max concurrent Gemini requests.
+        use_cache (bool): Whether to read and write the persistent result cache.
+
+    Returns:
+        PagedText: One page per run of source pages, with source "gemini", "partial" or
+                   "original" and page_count set to the number of PDF pages it covers.
+                   Returns an error string starting with "Error:" if every request failed.
+    """
+    document = PagedText.from_text(document)
+    max_chars = max(1, chunk_tokens * GEMINI_CHARS_PER_TOKEN)
+    page_groups = _group_pages(document, max_chars)
+    if not page_groups:
+        return PagedText()
+
+    # The chunks of every run, sent through one pool so oversized pages do not hold up the others
+    run_chunks = []
+    for group in page_groups:
+        run_text = document.buffer[group[0].start:group[-1].end]
+        run_chunks.append([run_text] if len(run_text) <= max_chars else split_text_into_chunks(run_text, chunk_tokens))
+    chunks = [chunk for chunks_of_run in run_chunks for chunk in chunks_of_run]
+    logging.info(f"Processing {len(document.pages)} page(s) with Gemini ({model_name}) as {len(page_groups)} run(s), {len(chunks)} request(s) of up to ~{chunk_tokens} tokens.")
+    results = iter(_process_chunks_with_gemini(chunks, api_key, rules_prompt, model_name, max_workers, use_cache))
+
+    processed_pages = []
+    first_error = None
+    for group, chunks_of_run in zip(page_groups, run_chunks):
+        stitched_parts = []
+        failed_chunks = 0
+        for chunk in chunks_of_run:
+            result, report = next(results)
+            if report["error"]:
+                failed_chunks += 1
+                first_error = first_error or report["error"]
+                stitched_parts.append(chunk)
+            elif result:
+                stitched_parts.append(result)
+        if failed_chunks:
+            logging.warning(f"Gemini failed for {failed_chunks} of {len(chunks_of_run)} request(s) of page(s) {group[0].page_number}-{group[-1].page_number}, keeping their original text.")
+        processed_pages.append({
+            "page_number": group[0].page_number,
+            "page_count": group[-1].page_number + group[-1].page_count - group[0].page_number,
+            "source": "gemini" if not failed_chunks else "original" if failed_chunks == len(chunks_of_run) else "partial",
+            "text": "\n\n".join(stitched_parts),
+        })
+
+    if all(page["source"] == "original" for page in processed_pages):
+        logging.error(f"All {len(chunks)} Gemini request(s) failed for model {model_name}.")
+        return first_error
+    return PagedText.from_pages(processed_pages)
+
+
+# --- Create SINGLE Word Document ---
+PLACEHOLDER_TEXT = "[No text extracted or processed for this file]"
+
+
+def _new_rtl_document():
+    """
+    Creates an empty Document whose Normal style is set up for Arabic:
+    Arial (including the complex script font), RTL and right alignment.
+    """
+    document = docx.Document()
+    # Set default font and RTL for Normal style (applied to new paragraphs)
+    style = document.styles['Normal']
+    font = style.font
+    font.name = 'Arial'
+    font.rtl = True # Set RTL on the style's font
+
+    # Using qn allows setting the font for complex scripts (like Arabic)
+    # Find or create the <w:rPr> element within the style definition
+    style_element = style.element
+    rpr_elements = style_element.xpath('.//w:rPr')
+    if not rpr_elements:
+        # If <w:rPr> doesn't exist, create it (very unlikely for Normal style)
+        rpr = docx_oxml.OxmlElement('w:rPr')
+        style_element.append(rpr)
+    else:
+        rpr = rpr_elements[0]
+
+    # Find or create the <w:rFonts> element within <w:rPr>
+    font_name_element = rpr.find(docx_ns.qn('w:rFonts'))
+    if font_name_element is None:
+         font_name_element = docx_oxml.OxmlElement('w:rFonts')
+         rpr.append(font_name_element)
+    # Set the complex script font attribute
+    font_name_element.set(docx_ns.qn('w:cs'), 'Arial') # Complex Script font
+
+    # Set default paragraph format to RTL for Normal style
+    paragraph_format = style.paragraph_format
+    paragraph_format.alignment = docx_text.WD_ALIGN_PARAGRAPH.RIGHT
+    paragraph_format.right_to_left = True
+    return document
+
+
+def _add_rtl_paragraph(document, text: str):
+    """Adds one right-aligned RTL Arial paragraph to the document."""
+    # Add paragraph - it should inherit style defaults (RTL, font)
+    paragraph = document.add_paragraph(text)
+    # Explicitly set format just in case (redundant but safe)
+    paragraph.paragraph_format.alignment = docx_text.WD_ALIGN_PARAGRAPH.RIGHT
+    paragraph.paragraph_format.right_to_left = True
+    # Explicitly set run font properties (redundant but safe)
+    for run in paragraph.runs:
+        run.font.name = 'Arial'
+        run.font.rtl = True
+        run.font.complex_script = True # Ensure complex script is handled
+    return paragraph
+
+
 def create_word_document(processed_text: str):
     """
     Creates a single Word document (.docx) in memory containing the processed text.
@@ -299,77 +2321,34 @@ def create_word_document(processed_text: str):
     Handles splitting text into paragraphs based on newlines.
 
     Args:
-        processed_text (str): The text to put into the document.
+        processed_text (str | PagedText): The text to put into the document.
 
     Returns:
-        io.BytesIO: A BytesIO stream containing the Word document data, or None on critical error.
-                    Returns stream with placeholder if processed_text is empty.
+        file-like: A stream from new_document_buffer (in memory, spilled to a temporary
+                   file when large) containing the Word document data, or None on critical error.
+                   Returns stream with placeholder if processed_text is empty.
     """
+    processed_text = _plain_text(processed_text)
     try:
-        document = Document()
-        # Set default font and RTL for Normal style (applied to new paragraphs)
-        style = document.styles['Normal']
-        font = style.font
-        font.name = 'Arial'
-        font.rtl = True # Set RTL on the style's font
-
-        # Using qn allows setting the font for complex scripts (like Arabic)
-        # Find or create the <w:rPr> element within the style definition
-        style_element = style.element
-        rpr_elements = style_element.xpath('.//w:rPr')
-        if not rpr_elements:
-            # If <w:rPr> doesn't exist, create it (very unlikely for Normal style)
-            rpr = OxmlElement('w:rPr')
-            style_element.append(rpr)
-        else:
-            rpr = rpr_elements[0]
-
-        # Find or create the <w:rFonts> element within <w:rPr>
-        font_name_element = rpr.find(qn('w:rFonts'))
-        if font_name_element is None:
-             font_name_element = OxmlElement('w:rFonts')
-             rpr.append(font_name_element)
-        # Set the complex script font attribute
-        font_name_element.set(qn('w:cs'), 'Arial') # Complex Script font
-
-        # Set default paragraph format to RTL for Normal style
-        paragraph_format = style.paragraph_format
-        paragraph_format.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-        paragraph_format.right_to_left = True
-
-        if processed_text and processed_text.strip():
-            # Split text into paragraphs based on newlines
-            lines = processed_text.strip().split('\n')
-            for line in lines:
-                if line.strip(): # Avoid adding empty paragraphs
-                    # Add paragraph - it should inherit style defaults (RTL, font)
-                    paragraph = document.add_paragraph(line.strip())
-                    # Explicitly set format just in case (redundant but safe)
-                    paragraph.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-                    paragraph.paragraph_format.right_to_left = True
-                    # Explicitly set run font properties (redundant but safe)
-                    for run in paragraph.runs:
-                        run.font.name = 'Arial'
-                        run.font.rtl = True
-                        run.font.complex_script = True # Ensure complex script is handled
-        else:
-            # Handle empty or whitespace-only content
-            empty_msg = "[No text extracted or processed for this file]"
-            paragraph = document.add_paragraph(empty_msg)
-            paragraph.italic = True # Make it visually distinct
-            # Ensure formatting is applied even for the placeholder
-            paragraph.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-            paragraph.paragraph_format.right_to_left = True
-            for run in paragraph.runs:
-                 run.font.name = 'Arial'
-                 run.font.rtl = True
-                 run.font.complex_script = True
-
-
-        # Save document to a BytesIO stream
-        doc_stream = io.BytesIO()
-        document.save(doc_stream)
-        doc_stream.seek(0)  # Rewind the stream to the beginning for reading
+        with span("docx_build", chars=len(processed_text)) as docx_span:
+            document = _new_rtl_document()
+
+            if processed_text and processed_text.strip():
+                # Split text into paragraphs based on newlines
+                lines = processed_text.strip().split('\n')
+                for line in lines:
+                    if line.strip(): # Avoid adding empty paragraphs
+                        _add_rtl_paragraph(document, line.strip())
+            else:
+                # Handle empty or whitespace-only content
+                paragraph = _add_rtl_paragraph(document, PLACEHOLDER_TEXT)
+                paragraph.italic = True # Make it visually distinct
+
+            # Save document to a BytesIO stream
+            doc_stream = new_document_buffer()
+            document.save(doc_stream)
+            docx_span["bytes"] = doc_stream.tell()
+            doc_stream.seek(0)  # Rewind the stream to the beginning for reading
         logging.info("Successfully created single Word document in memory.")
         return doc_stream
 
@@ -378,49 +2357,517 @@ def create_word_document(processed_text: str):
         return None # Indicate failure to create the document stream
 
 
+# --- Fast Word Document Builder ---
+# Paragraph XML identical to what _add_rtl_paragraph produces through python-docx
+_RTL_PARAGRAPH_XML_START = (
+    '<w:p><w:pPr><w:jc w:val="right"/></w:pPr>'
+    '<w:r><w:rPr><w:rFonts w:ascii="Arial" w:hAnsi="Arial"/><w:rtl/><w:cs/></w:rPr>'
+)
+_RTL_PARAGRAPH_XML_END = '</w:r></w:p>'
+_RUN_BREAK_PATTERN = re.compile(r"([\t\r\n])")
+# Characters XML 1.0 cannot hold (control characters from OCR, lone surrogates); they are dropped
+_XML_INVALID_PATTERN = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+
+def _text_element_xml(text: str) -> str:
+    """Returns a <w:t> element for text, preserving edge whitespace like python-docx does."""
+    if len(text.strip()) < len(text):
+        return f'<w:t xml:space="preserve">{xml_escape(text)}</w:t>'
+    return f'<w:t>{xml_escape(text)}</w:t>'
+
+
+def _rtl_paragraph_xml(text: str) -> str:
+    """
+    Returns the XML of one RTL Arial paragraph. Tabs become <w:tab/> and carriage
+    returns <w:br/>, as python-docx does when setting run text. Characters XML
+    cannot hold are removed, so one bad character does not fail the document.
+    """
+    text = _XML_INVALID_PATTERN.sub("", text)
+    if "\t" not in text and "\r" not in text and "\n" not in text:
+        return f"{_RTL_PARAGRAPH_XML_START}{_text_element_xml(text)}{_RTL_PARAGRAPH_XML_END}"
+    run_content = []
+    for segment in _RUN_BREAK_PATTERN.split(text):
+        if segment == "\t":
+            run_content.append("<w:tab/>")
+        elif segment in ("\r", "\n"):
+            run_content.append("<w:br/>")
+        elif segment:
+            run_content.append(_text_element_xml(segment))
+    return f"{_RTL_PARAGRAPH_XML_START}{''.join(run_content)}{_RTL_PARAGRAPH_XML_END}"
+
+
+def _append_paragraphs_xml(document, paragraph_xml: list[str]):
+    """Parses a batch of paragraph XML strings at once and appends them to the document body."""
+    if not paragraph_xml:
+        return
+    fragment = docx_oxml.parse_xml(f"<w:body {docx_ns.nsdecls('w')}>{''.join(paragraph_xml)}</w:body>")
+    section_properties = document.element.body.sectPr
+    for paragraph_element in list(fragment):
+        section_properties.addprevious(paragraph_element)
+
+
+def _text_to_paragraphs_xml(text):
+    """
+    Returns the paragraph XML for one file's text, split into paragraphs the way
+    create_word_document does, or the placeholder paragraph if it is empty.
+    text may also be a list of paragraph strings or a PagedText (whose paragraph
+    offsets are used instead of re-splitting the text).
+    """
+    if isinstance(text, PagedText):
+        lines = text.iter_paragraphs()
+    else:
+        lines = text if isinstance(text, list) else (text or "").strip().split('\n')
+    paragraph_xml = []
+    for line in lines:
+        line = line.strip()
+        if line: # Avoid adding empty paragraphs
+            paragraph_xml.append(_rtl_paragraph_xml(line))
+    if not paragraph_xml:
+        paragraph_xml.append(_rtl_paragraph_xml(PLACEHOLDER_TEXT))
+    return paragraph_xml
+
+
+def create_word_document_fast(processed_text: str):
+    """
+    Creates the same Word document as create_word_document, much faster.
+
+    Instead of building every paragraph and run through python-docx (which
+    re-applies alignment and fonts element by element), the paragraph XML is
+    generated as text and parsed in one go. The resulting document.xml is
+    identical to create_word_document's output.
+
+    Args:
+        processed_text (str | PagedText): The text to put into the document.
+
+    Returns:
+        file-like: A stream from new_document_buffer (in memory, spilled to a temporary
+                   file when large) containing the Word document data, or None on critical error.
+                   Returns stream with placeholder if processed_text is empty.
+    """
+    try:
+        with span("docx_build", chars=len(processed_text or "")) as docx_span:
+            document = _new_rtl_document()
+
+            paragraph_xml = _text_to_paragraphs_xml(processed_text)
+            _append_paragraphs_xml(document, paragraph_xml)
+
+            doc_stream = new_document_buffer()
+            document.save(doc_stream)
+            docx_span["bytes"] = doc_stream.tell()
+            doc_stream.seek(0)
+        logging.info(f"Successfully created single Word document in memory ({len(paragraph_xml)} paragraph(s)).")
+        return doc_stream
+
+    except Exception as e:
+        logging.error(f"Error creating single Word document: {e}", exc_info=True)
+        return None
+
+
+class StreamingDocumentWriter:
+    """
+    Builds a Word document one line at a time, e.g. while Gemini is still streaming.
+
+    Lines are turned into paragraphs as they arrive (formatted exactly like
+    create_word_document), so the full text never has to be held as one string.
+    Paragraph XML is appended to the document in batches of flush_every lines.
+    """
+
+    def __init__(self, flush_every: int = 500):
+        self.document = _new_rtl_document()
+        self.paragraph_count = 0
+        self._flush_every = flush_every
+        self._pending_xml = []
+
+    def add_line(self, line: str):
+        """Adds a line as a paragraph. Blank lines are skipped."""
+        line = line.strip()
+        if line:
+            self._pending_xml.append(_rtl_paragraph_xml(line))
+            self.paragraph_count += 1
+            if len(self._pending_xml) >= self._flush_every:
+                self.flush()
+
+    def flush(self):
+        """Appends any buffered paragraphs to the document."""
+        _append_paragraphs_xml(self.document, self._pending_xml)
+        self._pending_xml = []
+
+    def finish(self):
+        """
+        Saves the document, adding the placeholder paragraph if no text was written.
+
+        Returns:
+            file-like: The Word document data from new_document_buffer, rewound to the start.
+        """
+        if not self.paragraph_count:
+            self._pending_xml.append(_rtl_paragraph_xml(PLACEHOLDER_TEXT))
+        with span("docx_build") as docx_span:
+            self.flush()
+            doc_stream = new_document_buffer()
+            self.document.save(doc_stream)
+            docx_span["bytes"] = doc_stream.tell()
+            doc_stream.seek(0)
+        logging.info(f"Finished streamed Word document with {self.paragraph_count} paragraph(s).")
+        return doc_stream
+
+
 # --- Merging Function using docxcompose (Unchanged) ---
-def merge_word_documents(doc_streams_data: list[tuple[str, io.BytesIO]]):
+def merge_word_documents(doc_streams_data: list[tuple]):
     """
-    Merges multiple Word documents (provided as BytesIO streams) into one single document
+    Merges multiple Word documents (provided as streams) into one single document
     by direct concatenation without adding separators. Uses docxcompose library.
 
     Args:
-        doc_streams_data (list[tuple[str, io.BytesIO]]): A list of tuples,
-            where each tuple is (original_filename_str, word_doc_bytes_io_obj).
+        doc_streams_data (list[tuple]): A list of tuples, where each tuple is
+            (original_filename_str, word_doc_stream), the stream being any seekable
+            binary file object (io.BytesIO, a buffer from new_document_buffer, an open file).
 
     Returns:
-        io.BytesIO: A BytesIO stream containing the final merged Word document,
-                    or None on error or if input list is empty.
+        file-like: A stream from new_document_buffer containing the final merged Word document,
+                   or None on error or if input list is empty.
     """
     if not doc_streams_data:
         logging.warning("No document streams provided for merging.")
         return None
 
     try:
-        # --- Initialize Composer with the first document ---
-        first_filename, first_stream = doc_streams_data[0]
-        first_stream.seek(0)
-        master_doc = Document(first_stream)
-        logging.info(f"Loaded base document from '{first_filename}'.")
-        composer = Composer(master_doc)
-        logging.info(f"Initialized merger with base document.")
-
-        # --- Append remaining documents ---
-        for i in range(1, len(doc_streams_data)):
-            filename, stream = doc_streams_data[i]
-            stream.seek(0)
-            logging.info(f"Merging content directly from '{filename}'...")
-            sub_doc = Document(stream)
-            composer.append(sub_doc)
-            logging.info(f"Successfully appended content from '{filename}'.")
-
-        # --- Save the final merged document ---
-        merged_stream = io.BytesIO()
-        composer.save(merged_stream)
-        merged_stream.seek(0)
+        with span("merge", files=len(doc_streams_data)) as merge_span:
+            # --- Initialize Composer with the first document ---
+            first_filename, first_stream = doc_streams_data[0]
+            first_stream.seek(0)
+            master_doc = docx.Document(first_stream)
+            logging.info(f"Loaded base document from '{first_filename}'.")
+            composer = docxcompose.Composer(master_doc)
+            logging.info(f"Initialized merger with base document.")
+
+            # --- Append remaining documents ---
+            for i in range(1, len(doc_streams_data)):
+                filename, stream = doc_streams_data[i]
+                stream.seek(0)
+                logging.info(f"Merging content directly from '{filename}'...")
+                sub_doc = docx.Document(stream)
+                composer.append(sub_doc)
+                logging.info(f"Successfully appended content from '{filename}'.")
+
+            # --- Save the final merged document ---
+            merged_stream = new_document_buffer()
+            composer.save(merged_stream)
+            merge_span["bytes"] = merged_stream.tell()
+            merged_stream.seek(0)
         logging.info(f"Successfully merged {len(doc_streams_data)} documents by concatenation.")
         return merged_stream
 
     except Exception as e:
         logging.error(f"Error merging Word documents using docxcompose: {e}", exc_info=True)
         return None
+
+
+# --- Single-Pass Merge from Text ---
+def merge_texts_to_word_document(texts_data: list[tuple]):
+    """
+    Builds the final merged Word document straight from each file's processed text.
+
+    Produces the same document as creating one document per file and merging them
+    with merge_word_documents, but in a single pass: no per-file document is
+    serialized, zipped and parsed back. Use merge_word_documents for real,
+    externally created .docx files.
+
+    Args:
+        texts_data (list[tuple]): A list of (original_filename_str, text) tuples, where
+            text is the processed text (str or PagedText) or a list of paragraph strings.
+
+    Returns:
+        file-like: A stream from new_document_buffer containing the final merged Word document,
+                   or None on error or if input list is empty.
+    """
+    if not texts_data:
+        logging.warning("No texts provided for merging.")
+        return None
+
+    try:
+        with span("merge", files=len(texts_data)) as merge_span:
+            document = _new_rtl_document()
+            paragraph_count = 0
+            for filename, text in texts_data:
+                paragraph_xml = _text_to_paragraphs_xml(text)
+                _append_paragraphs_xml(document, paragraph_xml)
+                paragraph_count += len(paragraph_xml)
+
+            merged_stream = new_document_buffer()
+            document.save(merged_stream)
+            merge_span["bytes"] = merged_stream.tell()
+            merged_stream.seek(0)
+        logging.info(f"Successfully merged {len(texts_data)} text(s) into one document ({paragraph_count} paragraphs).")
+        return merged_stream
+
+    except Exception as e:
+        logging.error(f"Error merging texts into a Word document: {e}", exc_info=True)
+        return None
+
+
+# --- Pipelined Batch Processing ---
+_STAGE_STOP = object() # Sentinel telling a stage worker to exit
+# Item fields each stage produces, reported in its "stage_finished" event
+_STAGE_OUTPUT_FIELDS = {
+    "ocr": ("raw_text", "extraction_error"),
+    "llm": ("processed_text", "gemini_error", "gemini_warning", "chunk_reports"),
+    "docx": ("doc_stream", "docx_error"),
+}
+
+
+def _start_pipeline_stage(stage_name: str, stage_fn, in_queue, emit, worker_count: int, on_stage_finished, events):
+    """
+    Starts the worker threads for one pipeline stage.
+
+    Each worker takes items from in_queue until it sees _STAGE_STOP, runs
+    stage_fn(item) (unless the stage is in the item's "skip_stages") and hands
+    the item on with emit(item). Stage start/finish events are posted to the
+    events queue, the finish event with a snapshot of the stage's output fields.
+    When the last worker of the stage exits, on_stage_finished() is called so
+    the next stage can be stopped.
+    """
+    remaining_workers = [worker_count]
+    remaining_lock = threading.Lock()
+
+    def worker():
+        while True:
+            item = in_queue.get()
+            if item is _STAGE_STOP:
+                break
+            if stage_name not in item["skip_stages"]:
+                events.put(("stage_started", stage_name, item, None))
+                stage_fn(item)
+                stage_output = {field: item[field] for field in _STAGE_OUTPUT_FIELDS[stage_name]}
+                events.put(("stage_finished", stage_name, item, stage_output))
+            emit(item)
+        with remaining_lock:
+            remaining_workers[0] -= 1
+            is_last_worker = remaining_workers[0] == 0
+        if is_last_worker:
+            on_stage_finished()
+
+    threads = [
+        # Each worker runs in a copy of the caller's context, so its spans carry the batch ID
+        threading.Thread(target=contextvars.copy_context().run, args=(worker,), name=f"batch-{stage_name}-{i}", daemon=True)
+        for i in range(worker_count)
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def _batch_ocr_stage(item: dict, preprocess: bool = None):
+    """Batch stage 1: extracts text from the item's PDF, keeping its pages."""
+    try:
+        document = extract_document_from_pdf(item["file"], preprocess=preprocess)
+        if document is None:
+            item["extraction_error"] = "Error: Critical error during text extraction."
+        elif isinstance(document, str):
+            item["extraction_error"] = document
+        elif document.to_text().strip():
+            item["raw_document"] = document
+            item["raw_text"] = document.to_text() # The buffer itself, not a copy
+    except Exception as e:
+        logging.error(f"Unexpected error extracting text from '{item['filename']}': {e}", exc_info=True)
+        item["extraction_error"] = f"Error: Unexpected error during text extraction: {e}"
+    if item["extraction_error"]:
+        item["skip_stages"].update(("llm", "docx")) # Nothing to process, so no later stage reports a result
+
+
+def _batch_llm_stage(item: dict, api_key: str, rules_prompt: str, model_name: str, chunk_tokens: int):
+    """
+    Batch stage 2: processes the extracted text with Gemini.
+
+    When the text is chunked, the chunk reports are kept on the item, and failed
+    chunks (whose unprocessed text was kept) are reported in "gemini_warning".
+    """
+    if item["extraction_error"] or not item["raw_text"] or not item["raw_text"].strip():
+        return
+    try:
+        raw_text = item["raw_document"] or item["raw_text"]
+        if chunk_tokens and estimate_tokens(item["raw_text"]) > chunk_tokens:
+            chunked_result = process_text_with_gemini_chunked(api_key, raw_text, rules_prompt, model_name,
+                                                              chunk_tokens=chunk_tokens)
+            processed_text = chunked_result["text"]
+            item["chunk_reports"] = chunked_result["chunks"]
+            if chunked_result["failed_chunks"] and not processed_text.startswith("Error:"):
+                item["gemini_warning"] = (
+                    f"Warning: {chunked_result['failed_chunks']} of {len(chunked_result['chunks'])} Gemini chunk(s) "
+                    f"failed; their text was kept unprocessed. First error: "
+                    f"{next(report['error'] for report in chunked_result['chunks'] if report['error'])}"
+                )
+        else:
+            processed_text = process_text_with_gemini(api_key, raw_text, rules_prompt, model_name)
+        if processed_text is None or processed_text.startswith("Error:"):
+            item["gemini_error"] = processed_text or "Error: Unknown Gemini API error."
+        else:
+            item["processed_text"] = processed_text
+    except Exception as e:
+        logging.error(f"Unexpected error processing '{item['filename']}' with Gemini: {e}", exc_info=True)
+        item["gemini_error"] = f"Error: Unexpected error during Gemini processing: {e}"
+
+
+def _batch_docx_stage(item: dict):
+    """Batch stage 3: builds the file's intermediate Word document."""
+    if item["extraction_error"]:
+        return
+    try:
+        doc_stream = create_word_document_fast(item["processed_text"])
+        if doc_stream is None:
+            item["docx_error"] = "Error: Failed to create Word document (backend returned None)."
+        else:
+            item["doc_stream"] = doc_stream
+    except Exception as e:
+        logging.error(f"Unexpected error creating Word document for '{item['filename']}': {e}", exc_info=True)
+        item["docx_error"] = f"Error: Unexpected error during Word document creation: {e}"
+
+
+def _batch_filename(file_obj, index: int) -> str:
+    """Display name for a batch input: the file name of a path, or the object's .name."""
+    if isinstance(file_obj, (str, os.PathLike)):
+        return os.path.basename(os.fspath(file_obj))
+    return getattr(file_obj, "name", f"file_{index + 1}")
+
+
+def process_batch(files: list, api_key: str, rules_prompt: str, model_name: str, concurrency=None,
+                  progress_callback=None, chunk_tokens: int = None, queue_size: int = BATCH_QUEUE_SIZE,
+                  create_documents: bool = True, completed: dict = None, batch_id: str = None,
+                  preprocess: bool = None):
+    """
+    Processes a batch of PDFs through OCR, Gemini and Word document creation as a pipeline.
+
+    Each stage has its own pool of worker threads and the stages are connected by
+    bounded queues, so Vision, Gemini and document building all work at the same
+    time on different files while a slow stage holds back the ones before it.
+    The whole batch takes roughly as long as its slowest stage.
+
+    progress_callback is always called on the calling thread (so it may update
+    Streamlit elements) with one event dict at a time:
+        {"type": "stage_started", "stage": "ocr" | "llm" | "docx", "index": int, "filename": str}
+        {"type": "stage_finished", ... same keys ..., "output": dict} where output holds
+         the stage's result fields ("raw_text"/"extraction_error" for "ocr",
+         "processed_text"/"gemini_error"/"gemini_warning"/"chunk_reports" for "llm",
+         "doc_stream"/"docx_error" for "docx")
+        {"type": "file_done", "index": int, "filename": str, "result": dict,
+         "completed": int, "total": int}
+    "file_done" events arrive strictly in the order of `files`. A file whose OCR
+    failed has no "llm" or "docx" stage events.
+
+    Args:
+        files (list): PDF paths or file-like PDF objects with a .name (e.g. Streamlit
+            UploadedFile), in order. They are not copied into memory.
+        api_key (str): The Gemini API key.
+        rules_prompt (str): User-defined rules/instructions for Gemini.
+        model_name (str): The Gemini model ID to use.
+        concurrency (int | dict, optional): Workers per stage. An int sets the OCR and
+            Gemini pools; a dict may set any of "ocr", "llm" and "docx".
+            Defaults to BATCH_STAGE_WORKERS.
+        progress_callback (callable, optional): Receives the events described above.
+        chunk_tokens (int, optional): Passed on to process_text_with_gemini.
+        queue_size (int): Max items waiting between two stages.
+        create_documents (bool): Whether to build a Word document per file. Pass False
+            when the texts will be merged with merge_texts_to_word_document.
+        completed (dict, optional): Results already known from an earlier run, by file
+            index: {"raw_text": str} skips OCR, adding "processed_text" also skips Gemini.
+        batch_id (str, optional): ID attached to every instrumentation span of this batch
+            (see get_batch_summary). A new ID is generated if not given.
+        preprocess (bool, optional): Passed on to extract_text_from_pdf. Duplicate pages
+            are recognized across all files of the batch.
+
+    Every file's texts stay in the returned results, so memory grows with the total
+    text of the batch; only the documents (doc_stream) spill to disk.
+
+    Returns:
+        list[dict]: One result per file, in order, with keys "index", "filename", "batch_id",
+            "raw_text", "raw_document" (the OCR result as a PagedText, None if it came from
+            completed), "processed_text", "doc_stream" (a new_document_buffer stream or None),
+            "extraction_error", "gemini_error", "docx_error" (None or an "Error:" string),
+            "gemini_warning" (None, or a "Warning:" string if some Gemini chunks failed and
+            their unprocessed text was kept) and "chunk_reports" (the chunk reports of
+            process_text_with_gemini_chunked, or None if the text was not chunked).
+    """
+    if not files:
+        return []
+
+    stage_workers = dict(BATCH_STAGE_WORKERS)
+    if isinstance(concurrency, int):
+        stage_workers["ocr"] = stage_workers["llm"] = concurrency
+    elif concurrency:
+        stage_workers.update(concurrency)
+    stage_workers = {stage: max(1, workers) for stage, workers in stage_workers.items()}
+
+    total_files = len(files)
+    batch_id = batch_id or uuid.uuid4().hex[:12]
+    logging.info(f"Starting batch {batch_id} of {total_files} file(s) with stage workers {stage_workers}.")
+    with batch_context(batch_id), span("batch", files=total_files):
+        return _run_batch_pipeline(
+            files, api_key, rules_prompt, model_name, stage_workers, progress_callback,
+            chunk_tokens, queue_size, create_documents, completed or {}, batch_id, preprocess
+        )
+
+
+def _run_batch_pipeline(files, api_key, rules_prompt, model_name, stage_workers, progress_callback,
+                        chunk_tokens, queue_size, create_documents, completed, batch_id, preprocess):
+    """Runs the stages of process_batch and collects their results (see process_batch)."""
+    total_files = len(files)
+
+    events = queue.Queue()
+    ocr_queue = queue.Queue(maxsize=queue_size)
+    llm_queue = queue.Queue(maxsize=queue_size)
+    docx_queue = queue.Queue(maxsize=queue_size)
+
+    def stop_stage(stage_queue, worker_count):
+        return lambda: [stage_queue.put(_STAGE_STOP) for _ in range(worker_count)]
+
+    _start_pipeline_stage("ocr", lambda item: _batch_ocr_stage(item, preprocess), ocr_queue, llm_queue.put,
+                          stage_workers["ocr"], stop_stage(llm_queue, stage_workers["llm"]), events)
+    _start_pipeline_stage("llm", lambda item: _batch_llm_stage(item, api_key, rules_prompt, model_name, chunk_tokens),
+                          llm_queue, docx_queue.put, stage_workers["llm"], stop_stage(docx_queue, stage_workers["docx"]), events)
+    _start_pipeline_stage("docx", _batch_docx_stage, docx_queue, lambda item: events.put(("file_done", None, item, None)),
+                          stage_workers["docx"], lambda: None, events)
+
+    def feed():
+        for index, file_obj in enumerate(files):
+            item = {
+                "index": index, "filename": _batch_filename(file_obj, index), "batch_id": batch_id, "file": file_obj,
+                "raw_text": "", "raw_document": None, "processed_text": "", "doc_stream": None,
+                "extraction_error": None, "gemini_error": None, "docx_error": None,
+                "gemini_warning": None, "chunk_reports": None,
+                "skip_stages": set() if create_documents else {"docx"},
+            }
+            known_results = completed.get(index, {})
+            if "raw_text" in known_results:
+                item["raw_text"] = known_results["raw_text"]
+                item["skip_stages"].add("ocr")
+                if "processed_text" in known_results:
+                    item["processed_text"] = known_results["processed_text"]
+                    item["skip_stages"].add("llm")
+            ocr_queue.put(item)
+        stop_stage(ocr_queue, stage_workers["ocr"])()
+
+    threading.Thread(target=feed, name="batch-feeder", daemon=True).start()
+
+    # Collect on the calling thread, releasing finished files in the user's order
+    results = []
+    finished_items = {}
+    batch_start = time.perf_counter()
+    while len(results) < total_files:
+        event_type, stage_name, item, stage_output = events.get()
+        if event_type == "file_done":
+            finished_items[item["index"]] = item
+            while len(results) in finished_items:
+                result = finished_items.pop(len(results))
+                result.pop("file", None)
+                result.pop("skip_stages", None)
+                results.append(result)
+                if progress_callback:
+                    progress_callback({"type": "file_done", "index": result["index"], "filename": result["filename"],
+                                       "result": result, "completed": len(results), "total": total_files})
+        elif progress_callback:
+            stage_event = {"type": event_type, "stage": stage_name, "index": item["index"], "filename": item["filename"]}
+            if stage_output is not None:
+                stage_event["output"] = stage_output
+            progress_callback(stage_event)
+
+    logging.info(f"Finished batch {batch_id} of {total_files} file(s) in {time.perf_counter() - batch_start:.1f}s.")
+    return results
@@ -0,0 +1,445 @@
+# benchmark.py (Offline Backend Benchmarks)
+
+import argparse
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from google.api_core import exceptions as api_exceptions
+from google.cloud import vision
+import pymupdf # PyMuPDF
+
+import backend
+
+try:
+    import resource # Unix only; used for peak RSS
+except ImportError:
+    resource = None
+
+# Keep the backend's per-document INFO logging out of the timings
+logging.getLogger().setLevel(logging.WARNING)
+
+ARABIC_WORDS = [
+    "الحمد", "لله", "رب", "العالمين", "الرحمن", "الرحيم", "مالك", "يوم", "الدين",
+    "قال", "الشيخ", "رحمه", "الله", "تعالى", "في", "كتابه", "باب", "فصل", "العلم",
+    "والعمل", "وأما", "المسألة", "الأولى", "فإن", "هذا", "الحديث", "صحيح", "رواه",
+]
+
+
+def make_arabic_text(line_count: int, words_per_line: int = 12, seed: int = 0) -> str:
+    """Returns line_count lines of pseudo-random Arabic text (some with tabs, as in tables)."""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(line_count):
+        words = rng.choices(ARABIC_WORDS, k=words_per_line)
+        if i % 20 == 0:
+            words.insert(words_per_line // 2, "\t") # Simulate a tab-separated table row
+        lines.append(" ".join(words))
+    return "\n".join(lines)
+
+
+def _time_call(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of values (0.0 if there are none)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB (None where unsupported)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024 # bytes on macOS, KB elsewhere
+
+
+def _print_peak_rss():
+    peak = peak_rss_mb()
+    print(f"  peak RSS: {peak:.0f} MB" if peak is not None else "  peak RSS: n/a on this platform")
+
+
+# Heavy SDKs backend imports lazily; the import benchmark checks none of them load at import time
+HEAVY_MODULES = [
+    "google.generativeai", "google.cloud.vision", "google.api_core.exceptions",
+    "docx", "docxcompose", "pymupdf", "streamlit",
+]
+
+_IMPORT_PROBE = f"""
+import sys, time
+start = time.perf_counter()
+import backend
+seconds = time.perf_counter() - start
+print(seconds, ",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))
+"""
+
+
+def run_import_benchmark(runs: int):
+    """Times `import backend` in fresh interpreters (cold start of a Streamlit worker or script)."""
+    timings = []
+    loaded_modules = ""
+    project_dir = os.path.dirname(os.path.abspath(__file__))
+    for _ in range(runs):
+        probe = subprocess.run([sys.executable, "-c", _IMPORT_PROBE], cwd=project_dir,
+                               capture_output=True, text=True, check=True)
+        seconds, loaded_modules = (probe.stdout.strip().split(" ", 1) + [""])[:2]
+        timings.append(float(seconds))
+    print(f"import backend, {runs} fresh interpreter(s)")
+    print(f"  median {statistics.median(timings):.3f}s  min {min(timings):.3f}s  max {max(timings):.3f}s")
+    print(f"  heavy SDKs loaded at import: {loaded_modules or 'none'}")
+
+
+# --- Local Stand-ins for Vision and Gemini ---
+class _SimulatedService:
+    """Latency and transient-error simulation shared by the fake API clients."""
+
+    def __init__(self, latency: float, latency_per_unit: float, error_rate: float, seed: int):
+        self.latency = latency
+        self.latency_per_unit = latency_per_unit
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def simulate(self, units: float):
+        """
+        Sleeps like a real request of `units` pages/kilotokens, or raises a transient error.
+        Returns the call's sequence number.
+        """
+        with self._lock:
+            self.calls += 1
+            call_number = self.calls
+            jitter = self._rng.uniform(0.5, 1.5)
+            fails = self._rng.random() < self.error_rate
+        time.sleep((self.latency + self.latency_per_unit * units) * jitter)
+        if fails:
+            raise api_exceptions.ServiceUnavailable("Simulated transient error.")
+        return call_number
+
+
+class FakeVisionClient(_SimulatedService):
+    """
+    Stands in for vision.ImageAnnotatorClient: returns lines_per_page lines of
+    Arabic text for every requested page after a simulated delay.
+    """
+
+    def __init__(self, latency: float = 0.3, latency_per_page: float = 0.05, error_rate: float = 0.0,
+                 lines_per_page: int = 30, seed: int = 0):
+        super().__init__(latency, latency_per_page, error_rate, seed)
+        self.lines_per_page = lines_per_page
+
+    def batch_annotate_files(self, requests):
+        file_responses = []
+        for request in requests:
+            call_number = self.simulate(len(request.pages))
+            page_responses = [
+                vision.AnnotateImageResponse(full_text_annotation=vision.TextAnnotation(
+                    text=make_arabic_text(self.lines_per_page, seed=call_number * 1000 + page_number)
+                ))
+                for page_number in request.pages
+            ]
+            file_responses.append(vision.AnnotateFileResponse(responses=page_responses))
+        return vision.BatchAnnotateFilesResponse(responses=file_responses)
+
+
+class _FakeGeminiResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self.parts = [text] if text else []
+        self.prompt_feedback = None
+
+
+class FakeGeminiModel:
+    """
+    Stands in for genai.GenerativeModel: "processes" the text between the prompt's
+    --- markers by returning it unchanged, after a delay per 1000 estimated tokens.
+    """
+
+    def __init__(self, service: _SimulatedService):
+        self.service = service
+
+    def generate_content(self, prompt: str, stream: bool = False):
+        self.service.simulate(backend.estimate_tokens(prompt) / 1000)
+        text = prompt.split("---", 2)[1].strip() if prompt.count("---") >= 2 else ""
+        if not stream:
+            return _FakeGeminiResponse(text)
+        return iter([_FakeGeminiResponse(line + "\n") for line in text.split("\n")])
+
+
+def install_fake_backends(vision_latency: float = 0.3, vision_page_latency: float = 0.05,
+                          gemini_latency: float = 0.5, gemini_kilotoken_latency: float = 0.1,
+                          error_rate: float = 0.0, lines_per_page: int = 30, rate_limits: bool = False):
+    """
+    Routes the backend's Vision and Gemini calls to local fakes and gives it a
+    private, empty result cache so every run does the full work.
+    Unless rate_limits is True, the API rate limits are lifted as well.
+    """
+    vision_client = FakeVisionClient(vision_latency, vision_page_latency, error_rate, lines_per_page, seed=1)
+    gemini_service = _SimulatedService(gemini_latency, gemini_kilotoken_latency, error_rate, seed=2)
+    backend.override_api_clients(vision_client, lambda api_key, model_name: FakeGeminiModel(gemini_service))
+    backend.configure_result_cache(tempfile.mkdtemp(prefix="arabicpdf_bench_cache_"))
+    if not rate_limits:
+        for key in backend.RATE_LIMITS:
+            backend.configure_rate_limit(key)
+
+
+def make_image_only_pdf(page_count: int, path: str, seed: int = 0) -> str:
+    """Writes a PDF of blank (text-layer-free) pages, so every page goes to Vision."""
+    pdf_doc = pymupdf.open()
+    for _ in range(page_count):
+        pdf_doc.new_page()
+    pdf_doc.set_metadata({"title": f"benchmark-{seed}"}) # Distinct bytes per file
+    pdf_doc.save(path)
+    pdf_doc.close()
+    return path
+
+
+def make_scanned_pdf(page_count: int, path: str, scan_dpi: int = 300, blank_every: int = 10, repeat_every: int = 15) -> str:
+    """
+    Writes a PDF of A4 "scans": grayscale JPEG pages at scan_dpi with blocks of ink
+    laid out like lines of text. Every blank_every-th page is blank and every
+    repeat_every-th page is the same separator page (0 disables either).
+    """
+    pdf_doc = pymupdf.open()
+    for page_number in range(1, page_count + 1):
+        # Draw the page as vectors, then "scan" it: render to a grayscale JPEG image page
+        source_doc = pymupdf.open()
+        source_page = source_doc.new_page(width=595, height=842)
+        if not (blank_every and page_number % blank_every == 0):
+            is_separator = repeat_every and page_number % repeat_every == 0
+            rng = random.Random(-1 if is_separator else page_number)
+            shape = source_page.new_shape()
+            for line_top in range(72, 842 - 72, 48 if is_separator else 14):
+                x = 595 - 60
+                while x > 60: # Right to left, like Arabic
+                    word_width = rng.randint(12, 40)
+                    shape.draw_rect(pymupdf.Rect(max(60, x - word_width), line_top, x, line_top + 7))
+                    x -= word_width + 6
+            shape.finish(color=None, fill=(0.1, 0.1, 0.1))
+            shape.commit()
+        pixmap = source_page.get_pixmap(dpi=scan_dpi, colorspace=pymupdf.csGRAY, alpha=False)
+        source_doc.close()
+        page = pdf_doc.new_page(width=595, height=842)
+        page.insert_image(page.rect, stream=pixmap.tobytes("jpeg", jpg_quality=90))
+    pdf_doc.save(path)
+    pdf_doc.close()
+    return path
+
+
+def run_preprocess_benchmark(page_count: int, scan_dpi: int, blank_every: int, repeat_every: int, work_dir: str):
+    """OCR of a scanned book with and without preprocessing (blank/duplicate skipping, re-rendering)."""
+    pdf_path = make_scanned_pdf(page_count, os.path.join(work_dir, "scanned.pdf"), scan_dpi, blank_every, repeat_every)
+    print(f"1 scanned PDF x {page_count} pages at {scan_dpi} dpi ({os.path.getsize(pdf_path) / (1024 * 1024):.1f} MB), "
+          f"blank every {blank_every}, separator every {repeat_every}")
+    print(f"  {'':<16} {'OCR time':>9} {'pages sent':>11} {'MB uploaded':>12}")
+    for preprocess in (False, True):
+        batch_id = f"preprocess-{preprocess}"
+        backend.configure_result_cache(tempfile.mkdtemp(prefix="arabicpdf_bench_cache_")) # Cold cache per run
+        with backend.batch_context(batch_id):
+            seconds, raw_text = _time_call(lambda: backend.extract_text_from_pdf(pdf_path, preprocess=preprocess))
+        vision_spans = [span for span in backend.get_spans(batch_id) if span["name"] == "vision_request"]
+        pages_sent = sum(span["pages"] for span in vision_spans)
+        megabytes = sum(span["bytes"] for span in vision_spans) / (1024 * 1024)
+        label = "preprocessed" if preprocess else "as is"
+        print(f"  {label:<16} {seconds:>8.2f}s {pages_sent:>11} {megabytes:>12.1f}{' FAILED' if raw_text.startswith('Error:') else ''}")
+    stats = backend.get_preprocess_stats()
+    print(f"  saved: {stats['blank_pages']} blank + {stats['duplicate_pages']} duplicate pages, "
+          f"{stats['bytes_saved'] / (1024 * 1024):.1f} MB of {stats['bytes_original'] / (1024 * 1024):.1f} MB uploads")
+    _print_peak_rss()
+
+
+def _print_span_latencies(batch_id: str, stage_names: list[str]):
+    spans = backend.get_spans(batch_id)
+    for stage_name in stage_names:
+        durations = [span["seconds"] for span in spans if span["name"] == stage_name]
+        if durations:
+            print(f"  {stage_name:<15} {len(durations):>5} calls  p50 {_percentile(durations, 0.5):.2f}s  p95 {_percentile(durations, 0.95):.2f}s")
+
+
+def run_large_pdf_benchmark(page_count: int, chunk_tokens: int, work_dir: str, paged: bool = False):
+    """
+    One large image-only PDF: Vision OCR of every page, then chunked Gemini processing,
+    or with paged=True page-by-page processing by process_document_with_gemini.
+    """
+    pdf_path = make_image_only_pdf(page_count, os.path.join(work_dir, "large.pdf"))
+    with backend.batch_context("large-pdf"):
+        if paged:
+            ocr_seconds, raw_text = _time_call(backend.extract_document_from_pdf, pdf_path)
+            gemini_seconds, processed_text = _time_call(
+                lambda: backend.process_document_with_gemini("offline", raw_text, "Rules", "fake-model",
+                                                             chunk_tokens=chunk_tokens or backend.GEMINI_DEFAULT_CHUNK_TOKENS)
+            )
+        else:
+            ocr_seconds, raw_text = _time_call(backend.extract_text_from_pdf, pdf_path)
+            gemini_seconds, processed_text = _time_call(
+                lambda: backend.process_text_with_gemini("offline", raw_text, "Rules", "fake-model", chunk_tokens=chunk_tokens)
+            )
+    failed = str(raw_text).startswith("Error:") or str(processed_text).startswith("Error:")
+    print(f"1 PDF x {page_count} pages ({len(raw_text)} chars){' FAILED' if failed else ''}")
+    if paged and not failed:
+        sources = Counter(page.source for page in processed_text.pages)
+        print(f"  runs:   {len(processed_text.pages)} ({', '.join(f'{count} {source}' for source, count in sorted(sources.items()))})")
+    print(f"  OCR:    {ocr_seconds:.2f}s ({page_count / ocr_seconds:.1f} pages/s)")
+    print(f"  Gemini: {gemini_seconds:.2f}s")
+    print(f"  total:  {ocr_seconds + gemini_seconds:.2f}s ({1 / (ocr_seconds + gemini_seconds):.2f} files/s)")
+    _print_span_latencies("large-pdf", ["vision_request", "gemini_call"])
+    _print_peak_rss()
+
+
+def run_many_pdfs_benchmark(file_count: int, pages_per_file: int, concurrency: int, chunk_tokens: int, work_dir: str):
+    """Many small image-only PDFs through process_batch and the single-pass merge."""
+    pdf_paths = [
+        make_image_only_pdf(pages_per_file, os.path.join(work_dir, f"small_{i:04d}.pdf"), seed=i)
+        for i in range(file_count)
+    ]
+    file_started = {}
+    file_latencies = []
+
+    def track_latency(event):
+        if event["type"] == "stage_started":
+            file_started.setdefault(event["index"], time.perf_counter())
+        elif event["type"] == "file_done":
+            file_latencies.append(time.perf_counter() - file_started.get(event["index"], time.perf_counter()))
+
+    start = time.perf_counter()
+    results = backend.process_batch(
+        pdf_paths, "offline", "Rules", "fake-model", concurrency=concurrency, progress_callback=track_latency,
+        chunk_tokens=chunk_tokens, create_documents=False, batch_id="many-pdfs"
+    )
+    with backend.batch_context("many-pdfs"):
+        merged_stream = backend.merge_texts_to_word_document([(r["filename"], r["processed_text"]) for r in results])
+    seconds = time.perf_counter() - start
+    if merged_stream is not None:
+        merged_stream.close()
+
+    failed_files = sum(1 for r in results if r["extraction_error"] or r["gemini_error"])
+    print(f"{file_count} PDFs x {pages_per_file} pages, {failed_files} failed")
+    print(f"  total: {seconds:.2f}s ({file_count / seconds:.2f} files/s)")
+    print(f"  per-file latency: p50 {_percentile(file_latencies, 0.5):.2f}s  p95 {_percentile(file_latencies, 0.95):.2f}s")
+    _print_span_latencies("many-pdfs", ["vision_request", "gemini_call", "merge"])
+    _print_peak_rss()
+
+
+def run_docx_benchmark(line_counts: list[int], skip_current_above: int = 0):
+    """
+    Compares create_word_document with create_word_document_fast.
+    create_word_document grows quadratically with line count, so it can be
+    skipped above skip_current_above lines (0 = never skip).
+    """
+    print(f"{'lines':>8} {'create_word_document':>22} {'create_word_document_fast':>27} {'speedup':>9}")
+    for line_count in line_counts:
+        text = make_arabic_text(line_count)
+        fast_seconds, fast_stream = _time_call(backend.create_word_document_fast, text)
+        if skip_current_above and line_count > skip_current_above:
+            print(f"{line_count:>8} {'skipped':>22} {fast_seconds:>26.2f}s {'-':>9}")
+            continue
+        slow_seconds, slow_stream = _time_call(backend.create_word_document, text)
+        if slow_stream is None or fast_stream is None:
+            print(f"{line_count:>8} document creation failed")
+            continue
+        slow_stream.close()
+        fast_stream.close()
+        print(f"{line_count:>8} {slow_seconds:>21.2f}s {fast_seconds:>26.2f}s {slow_seconds / fast_seconds:>8.1f}x")
+    _print_peak_rss()
+
+
+def run_merge_benchmark(file_count: int, lines_per_file: int):
+    """
+    Compares per-file documents + merge_word_documents with the single-pass
+    merge_texts_to_word_document on the same texts.
+    """
+    texts_data = [(f"file_{i + 1}.pdf", make_arabic_text(lines_per_file, seed=i)) for i in range(file_count)]
+
+    start = time.perf_counter()
+    doc_streams_data = [(filename, backend.create_word_document_fast(text)) for filename, text in texts_data]
+    merged_stream = backend.merge_word_documents(doc_streams_data)
+    per_file_seconds = time.perf_counter() - start
+
+    single_pass_seconds, single_pass_stream = _time_call(backend.merge_texts_to_word_document, texts_data)
+    for stream in [merged_stream, single_pass_stream] + [stream for _, stream in doc_streams_data]:
+        stream.close()
+
+    print(f"{file_count} files x {lines_per_file} lines")
+    print(f"  per-file documents + merge_word_documents: {per_file_seconds:.2f}s")
+    print(f"  merge_texts_to_word_document:              {single_pass_seconds:.2f}s ({per_file_seconds / single_pass_seconds:.1f}x)")
+    _print_peak_rss()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for backend.py.")
+    subparsers = parser.add_subparsers(dest="scenario", required=True)
+
+    docx_parser = subparsers.add_parser("docx", help="Word document creation: current vs fast builder.")
+    docx_parser.add_argument("--lines", type=int, nargs="+", default=[1000, 10000, 100000],
+                             help="Line counts to benchmark (default: 1000 10000 100000).")
+    docx_parser.add_argument("--skip-current-above", type=int, default=20000,
+                             help="Skip the (quadratic) current function above this many lines; 0 runs it everywhere.")
+
+    merge_parser = subparsers.add_parser("merge", help="Merging: per-file documents vs single-pass merge from text.")
+    merge_parser.add_argument("--files", type=int, default=200, help="Number of files (default: 200).")
+    merge_parser.add_argument("--lines-per-file", type=int, default=50, help="Lines per file (default: 50).")
+
+    import_parser = subparsers.add_parser("import", help="Cold-start time of `import backend`.")
+    import_parser.add_argument("--runs", type=int, default=10, help="Fresh interpreters to time (default: 10).")
+
+    # Scenarios that run the OCR/Gemini pipeline against the local fakes
+    fake_api_parser = argparse.ArgumentParser(add_help=False)
+    fake_api_parser.add_argument("--vision-latency", type=float, default=0.3, help="Seconds per fake Vision request (default: 0.3).")
+    fake_api_parser.add_argument("--vision-page-latency", type=float, default=0.05, help="Extra seconds per page (default: 0.05).")
+    fake_api_parser.add_argument("--gemini-latency", type=float, default=0.5, help="Seconds per fake Gemini request (default: 0.5).")
+    fake_api_parser.add_argument("--gemini-kilotoken-latency", type=float, default=0.1,
+                                 help="Extra seconds per 1000 prompt tokens (default: 0.1).")
+    fake_api_parser.add_argument("--error-rate", type=float, default=0.0, help="Share of fake requests failing transiently (default: 0).")
+    fake_api_parser.add_argument("--lines-per-page", type=int, default=30, help="Arabic lines the fake Vision returns per page (default: 30).")
+    fake_api_parser.add_argument("--chunk-tokens", type=int, default=backend.GEMINI_DEFAULT_CHUNK_TOKENS,
+                                 help="Max tokens per Gemini request; 0 disables chunking.")
+    fake_api_parser.add_argument("--rate-limits", action="store_true", help="Keep the production API rate limits.")
+
+    large_pdf_parser = subparsers.add_parser("large-pdf", parents=[fake_api_parser], help="One large PDF via fake Vision + Gemini.")
+    large_pdf_parser.add_argument("--pages", type=int, default=300, help="Pages in the PDF (default: 300).")
+    large_pdf_parser.add_argument("--paged", action="store_true",
+                                  help="Keep the page structure (extract_document_from_pdf + process_document_with_gemini).")
+
+    many_pdfs_parser = subparsers.add_parser("many-pdfs", parents=[fake_api_parser], help="Many small PDFs via process_batch.")
+    many_pdfs_parser.add_argument("--files", type=int, default=100, help="Number of PDFs (default: 100).")
+    many_pdfs_parser.add_argument("--pages-per-file", type=int, default=3, help="Pages per PDF (default: 3).")
+    many_pdfs_parser.add_argument("--concurrency", type=int, default=None, help="Workers for the OCR and Gemini stages.")
+
+    preprocess_parser = subparsers.add_parser("preprocess", parents=[fake_api_parser],
+                                              help="Scanned PDF OCR with vs without preprocessing.")
+    preprocess_parser.add_argument("--pages", type=int, default=60, help="Pages in the scanned PDF (default: 60).")
+    preprocess_parser.add_argument("--scan-dpi", type=int, default=600, help="Resolution of the scans (default: 600).")
+    preprocess_parser.add_argument("--blank-every", type=int, default=10, help="Every Nth page is blank (default: 10; 0 = none).")
+    preprocess_parser.add_argument("--repeat-every", type=int, default=15,
+                                   help="Every Nth page is the same separator page (default: 15; 0 = none).")
+
+    args = parser.parse_args()
+    if args.scenario == "docx":
+        run_docx_benchmark(args.lines, args.skip_current_above)
+    elif args.scenario == "merge":
+        run_merge_benchmark(args.files, args.lines_per_file)
+    elif args.scenario == "import":
+        run_import_benchmark(args.runs)
+    else:
+        install_fake_backends(args.vision_latency, args.vision_page_latency, args.gemini_latency,
+                              args.gemini_kilotoken_latency, args.error_rate, args.lines_per_page, args.rate_limits)
+        with tempfile.TemporaryDirectory(prefix="arabicpdf_bench_") as work_dir:
+            if args.scenario == "large-pdf":
+                run_large_pdf_benchmark(args.pages, args.chunk_tokens or None, work_dir, args.paged)
+            elif args.scenario == "preprocess":
+                run_preprocess_benchmark(args.pages, args.scan_dpi, args.blank_every, args.repeat_every, work_dir)
+            else:
+                run_many_pdfs_benchmark(args.files, args.pages_per_file, args.concurrency, args.chunk_tokens or None, work_dir)
@@ -0,0 +1,456 @@
+# jobs.py (Checkpointed, Resumable Batch Jobs)
+
+import argparse
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import time
+import uuid
+
+import backend
+
+# Where job state lives: a SQLite database plus a directory of blobs (PDFs and texts)
+JOB_STORE_DIR = os.environ.get("ARABICPDF_JOB_DIR", "arabicpdf_jobs")
+# Retention: jobs untouched for this long are deleted, and the oldest jobs are deleted
+# while the blobs take more than JOB_STORE_MAX_BYTES (swept whenever a job is created)
+JOB_RETENTION_HOURS = float(os.environ.get("ARABICPDF_JOB_RETENTION_HOURS", "72"))
+JOB_STORE_MAX_BYTES = int(os.environ.get("ARABICPDF_JOB_STORE_MAX_MB", "2048")) * 1024 * 1024
+
+# Per-file stages, in pipeline order. A file's "stage" is the last one it completed.
+FILE_STAGES = ["pending", "ocr", "llm"]
+
+
+class JobStore:
+    """
+    Persists batch jobs so they can be resumed after a crash, restart or lost session.
+
+    Job and per-file metadata live in <root_dir>/jobs.sqlite3. Input PDFs, OCR text,
+    processed text and the merged document live under <root_dir>/blobs/<job_id>/.
+    Each stage result is written as soon as that stage finishes for a file.
+
+    Jobs may have an owner (e.g. one per app session), so that users of a shared
+    store only see their own jobs. Inputs of completed jobs are deleted, and old
+    jobs are swept (see sweep).
+    """
+
+    def __init__(self, root_dir: str = JOB_STORE_DIR):
+        self.root_dir = root_dir
+        self.blob_dir = os.path.join(root_dir, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.db_path = os.path.join(root_dir, "jobs.sqlite3")
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    status TEXT NOT NULL,
+                    model_name TEXT NOT NULL,
+                    rules_prompt TEXT NOT NULL,
+                    chunk_tokens INTEGER,
+                    merged_path TEXT,
+                    owner TEXT
+                );
+                CREATE TABLE IF NOT EXISTS job_files (
+                    job_id TEXT NOT NULL,
+                    file_index INTEGER NOT NULL,
+                    filename TEXT NOT NULL,
+                    pdf_path TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    error TEXT,
+                    PRIMARY KEY (job_id, file_index)
+                );
+            """)
+            job_columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if "owner" not in job_columns: # Stores created before jobs had owners
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    def _connect(self):
+        # A short-lived connection per operation: Streamlit reruns scripts on different threads
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _job_blob_dir(self, job_id: str) -> str:
+        return os.path.join(self.blob_dir, job_id)
+
+    def _text_blob_path(self, job_id: str, file_index: int, stage: str) -> str:
+        return os.path.join(self._job_blob_dir(job_id), f"{file_index:05d}.{stage}.txt")
+
+    def create_job(self, pdf_sources: list, rules_prompt: str, model_name: str, chunk_tokens: int = None,
+                   owner: str = None) -> str:
+        """
+        Creates a job, copying every input PDF into the blob directory so the job
+        can be resumed even after the original uploads are gone. Old jobs are swept first.
+
+        Args:
+            pdf_sources (list): PDF paths or file-like objects with a .name, in order.
+            rules_prompt (str): User-defined rules/instructions for Gemini.
+            model_name (str): The Gemini model ID to use.
+            chunk_tokens (int, optional): Passed on to process_text_with_gemini.
+            owner (str, optional): Who may list and resume the job (see list_jobs).
+
+        Returns:
+            str: The new job's ID.
+        """
+        self.sweep()
+        job_id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+        job_dir = self._job_blob_dir(job_id)
+        os.makedirs(job_dir)
+        now = time.time()
+
+        file_rows = []
+        for file_index, pdf_source in enumerate(pdf_sources):
+            filename = backend._batch_filename(pdf_source, file_index)
+            pdf_path = os.path.join(job_dir, f"{file_index:05d}.pdf")
+            if isinstance(pdf_source, (str, os.PathLike)):
+                shutil.copyfile(pdf_source, pdf_path)
+            else:
+                pdf_source.seek(0)
+                with open(pdf_path, "wb") as f:
+                    shutil.copyfileobj(pdf_source, f)
+                pdf_source.seek(0)
+            file_rows.append((job_id, file_index, filename, pdf_path, "pending", None))
+
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, created_at, updated_at, status, model_name, rules_prompt, chunk_tokens, owner) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, now, now, "pending", model_name, rules_prompt or "", chunk_tokens, owner),
+            )
+            conn.executemany("INSERT INTO job_files VALUES (?, ?, ?, ?, ?, ?)", file_rows)
+        logging.info(f"Created job {job_id} with {len(file_rows)} file(s) in {job_dir}.")
+        return job_id
+
+    def get_job(self, job_id: str):
+        """
+        Returns:
+            dict | None: The job's fields plus "files", a list of per-file dicts in order.
+        """
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            job_row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if job_row is None:
+                return None
+            file_rows = conn.execute("SELECT * FROM job_files WHERE job_id = ? ORDER BY file_index", (job_id,)).fetchall()
+        job = dict(job_row)
+        job["files"] = [dict(file_row) for file_row in file_rows]
+        return job
+
+    def list_jobs(self, owner: str = None):
+        """Returns the jobs (without files) of owner, or every job if owner is None, newest first."""
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            if owner is None:
+                rows = conn.execute("SELECT * FROM jobs ORDER BY created_at DESC")
+            else:
+                rows = conn.execute("SELECT * FROM jobs WHERE owner = ? ORDER BY created_at DESC", (owner,))
+            return [dict(row) for row in rows]
+
+    def delete_job(self, job_id: str):
+        """Deletes a job's rows and all of its blobs."""
+        shutil.rmtree(self._job_blob_dir(job_id), ignore_errors=True)
+        with self._connect() as conn:
+            conn.execute("DELETE FROM job_files WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def purge_job_inputs(self, job_id: str):
+        """Deletes a job's input PDFs and stage texts, keeping its merged document (if any)."""
+        job_dir = self._job_blob_dir(job_id)
+        if not os.path.isdir(job_dir):
+            return
+        for blob_name in os.listdir(job_dir):
+            if blob_name.endswith((".pdf", ".txt", ".tmp")):
+                os.remove(os.path.join(job_dir, blob_name))
+
+    def _job_blob_bytes(self, job_id: str) -> int:
+        job_dir = self._job_blob_dir(job_id)
+        if not os.path.isdir(job_dir):
+            return 0
+        return sum(entry.stat().st_size for entry in os.scandir(job_dir) if entry.is_file())
+
+    def sweep(self, max_age_hours: float = None, max_bytes: int = None) -> int:
+        """
+        Deletes jobs not updated for max_age_hours, then the oldest jobs that are not
+        running until the blobs take at most max_bytes.
+
+        Args:
+            max_age_hours (float, optional): Defaults to JOB_RETENTION_HOURS.
+            max_bytes (int, optional): Defaults to JOB_STORE_MAX_BYTES.
+
+        Returns:
+            int: The number of jobs deleted.
+        """
+        max_age_hours = JOB_RETENTION_HOURS if max_age_hours is None else max_age_hours
+        max_bytes = JOB_STORE_MAX_BYTES if max_bytes is None else max_bytes
+        cutoff = time.time() - max_age_hours * 3600
+        jobs_oldest_first = sorted(self.list_jobs(), key=lambda job: job["updated_at"])
+
+        deleted_jobs = 0
+        remaining_jobs = []
+        for job in jobs_oldest_first:
+            if job["updated_at"] < cutoff:
+                self.delete_job(job["job_id"])
+                deleted_jobs += 1
+            else:
+                remaining_jobs.append(job)
+
+        job_bytes = {job["job_id"]: self._job_blob_bytes(job["job_id"]) for job in remaining_jobs}
+        total_bytes = sum(job_bytes.values())
+        for job in remaining_jobs:
+            if total_bytes <= max_bytes:
+                break
+            if job["status"] == "running":
+                continue
+            self.delete_job(job["job_id"])
+            total_bytes -= job_bytes[job["job_id"]]
+            deleted_jobs += 1
+
+        if deleted_jobs:
+            logging.info(f"Swept {deleted_jobs} job(s) from the job store ({total_bytes} bytes of blobs left).")
+        return deleted_jobs
+
+    def set_job_status(self, job_id: str, status: str, merged_path: str = None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, updated_at = ?, merged_path = COALESCE(?, merged_path) WHERE job_id = ?",
+                (status, time.time(), merged_path, job_id),
+            )
+
+    def save_stage_result(self, job_id: str, file_index: int, stage: str, text: str):
+        """Writes a file's stage output to its blob, then marks the stage as completed."""
+        blob_path = self._text_blob_path(job_id, file_index, stage)
+        temp_path = f"{blob_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temp_path, blob_path) # Never leave a half-written checkpoint behind
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE job_files SET stage = ?, error = NULL WHERE job_id = ? AND file_index = ?",
+                (stage, job_id, file_index),
+            )
+
+    def save_file_error(self, job_id: str, file_index: int, error: str):
+        with self._connect() as conn:
+            conn.execute("UPDATE job_files SET error = ? WHERE job_id = ? AND file_index = ?", (error, job_id, file_index))
+
+    def has_stage_result(self, job_id: str, file_index: int, stage: str) -> bool:
+        return os.path.exists(self._text_blob_path(job_id, file_index, stage))
+
+    def load_stage_result(self, job_id: str, file_index: int, stage: str) -> str:
+        with open(self._text_blob_path(job_id, file_index, stage), "r", encoding="utf-8") as f:
+            return f.read()
+
+    def completed_results(self, job: dict):
+        """
+        Returns the stage results already stored for a job, in the form
+        backend.process_batch takes for its `completed` argument.
+        """
+        completed = {}
+        for job_file in job["files"]:
+            stage_rank = FILE_STAGES.index(job_file["stage"])
+            if stage_rank >= FILE_STAGES.index("ocr"):
+                known_results = {"raw_text": self.load_stage_result(job["job_id"], job_file["file_index"], "ocr")}
+                if stage_rank >= FILE_STAGES.index("llm"):
+                    known_results["processed_text"] = self.load_stage_result(job["job_id"], job_file["file_index"], "llm")
+                completed[job_file["file_index"]] = known_results
+        return completed
+
+
+_default_store = None
+
+def get_default_store():
+    """Returns the JobStore at JOB_STORE_DIR, creating it on first use."""
+    global _default_store
+    if _default_store is None:
+        _default_store = JobStore(JOB_STORE_DIR)
+    return _default_store
+
+
+def run_job(store: JobStore, job_id: str, api_key: str, concurrency=None, progress_callback=None, merge: bool = True,
+            preprocess: bool = None):
+    """
+    Runs (or resumes) a job through backend.process_batch and writes the merged document.
+
+    Files whose OCR and Gemini results are already stored skip those stages, so a
+    resumed job only pays for the work that was not checkpointed. Once a job is
+    completed, its input PDFs and stage texts are deleted. Failed stages are
+    not checkpointed and are retried on the next run, and so is processed text with
+    failed Gemini chunks (the chunks that succeeded come from the result cache). The job ID is used as the
+    batch ID, so backend.get_batch_summary(job_id) shows where the time went.
+
+    Args:
+        store (JobStore): The store holding the job.
+        job_id (str): The job to run.
+        api_key (str): The Gemini API key.
+        concurrency (int | dict, optional): Passed on to backend.process_batch.
+        progress_callback (callable, optional): Receives backend.process_batch events.
+        merge (bool): Whether to write the merged document. Callers that merge the
+            results themselves (like the Streamlit app) pass False.
+        preprocess (bool, optional): Passed on to backend.process_batch.
+
+    Returns:
+        tuple[list[dict], str | None]: The per-file batch results and the path of the
+            merged document (None if not merged or no file could be processed).
+    """
+    job = store.get_job(job_id)
+    if job is None:
+        raise ValueError(f"Unknown job: {job_id}")
+    if job["status"] == "completed":
+        raise ValueError(f"Job {job_id} is already completed (its inputs have been deleted).")
+
+    completed = store.completed_results(job)
+    logging.info(f"Running job {job_id}: {len(job['files'])} file(s), {len(completed)} with stored stage results.")
+    store.set_job_status(job_id, "running")
+
+    filenames = [job_file["filename"] for job_file in job["files"]]
+
+    def checkpoint(event):
+        event["filename"] = filenames[event["index"]] # Show the original name, not the blob name
+        if "result" in event:
+            event["result"]["filename"] = event["filename"]
+        if event["type"] == "stage_finished" and event["stage"] in ("ocr", "llm"):
+            output = event["output"]
+            # Partly processed text (some Gemini chunks failed) is not checkpointed, so resuming retries it
+            error = output.get("extraction_error") or output.get("gemini_error") or output.get("gemini_warning")
+            if error:
+                store.save_file_error(job_id, event["index"], error)
+            else:
+                text_field = "raw_text" if event["stage"] == "ocr" else "processed_text"
+                store.save_stage_result(job_id, event["index"], event["stage"], output[text_field])
+        if progress_callback:
+            progress_callback(event)
+
+    pdf_paths = [job_file["pdf_path"] for job_file in job["files"]]
+    results = backend.process_batch(
+        pdf_paths, api_key, job["rules_prompt"], job["model_name"], concurrency=concurrency,
+        progress_callback=checkpoint, chunk_tokens=job["chunk_tokens"],
+        create_documents=False, completed=completed, batch_id=job_id, preprocess=preprocess,
+    )
+    texts_data = [(result["filename"], result["processed_text"]) for result in results if not result["extraction_error"]]
+    merged_path = None
+    if merge and texts_data:
+        with backend.batch_context(job_id):
+            merged_stream = backend.merge_texts_to_word_document(texts_data)
+        if merged_stream is not None:
+            merged_path = os.path.join(store._job_blob_dir(job_id), "merged.docx")
+            with open(merged_path, "wb") as f:
+                shutil.copyfileobj(merged_stream, f)
+            merged_stream.close()
+
+    finished_job = store.get_job(job_id)
+    # A file is only done once both its OCR and Gemini results are stored without a later error
+    all_files_done = all(
+        job_file["stage"] == "llm" and job_file["error"] is None
+        and store.has_stage_result(job_id, job_file["file_index"], "ocr")
+        for job_file in finished_job["files"]
+    )
+    status = "completed" if all_files_done and (merged_path or not merge) else "incomplete"
+    store.set_job_status(job_id, status, merged_path)
+    if status == "completed":
+        store.purge_job_inputs(job_id)
+    logging.info(f"Job {job_id} finished with status '{status}'.")
+    return results, merged_path
+
+
+def _print_progress(event):
+    if event["type"] == "stage_started":
+        print(f"  [{event['index'] + 1}] {event['filename']}: {event['stage']}...", flush=True)
+    elif event["type"] == "file_done":
+        result = event["result"]
+        error = result["extraction_error"] or result["gemini_error"]
+        if error:
+            status = f"ERROR {error}"
+        elif result["gemini_warning"]:
+            status = f"done with issues: {result['gemini_warning']}"
+        else:
+            status = "done"
+        print(f"({event['completed']}/{event['total']}) {result['filename']}: {status}", flush=True)
+
+
+def _print_job_status(job: dict):
+    print(f"Job {job['job_id']} [{job['status']}] model={job['model_name']} merged={job['merged_path'] or '-'}")
+    for job_file in job["files"]:
+        error = f"  error: {job_file['error']}" if job_file["error"] else ""
+        print(f"  {job_file['file_index'] + 1:>4}. {job_file['filename']}: {job_file['stage']}{error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run ArabicPDF batch jobs without the Streamlit UI.")
+    parser.add_argument("--store", default=JOB_STORE_DIR, help=f"Job store directory (default: {JOB_STORE_DIR}).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Create a job from PDFs and run it.")
+    run_parser.add_argument("pdfs", nargs="+", help="PDF files, in merge order.")
+    run_parser.add_argument("--rules", required=True, help="File containing the Gemini extraction rules.")
+    run_parser.add_argument("--model", default="gemini-1.5-flash-latest", help="Gemini model ID.")
+    run_parser.add_argument("--chunk-tokens", type=int, default=backend.GEMINI_DEFAULT_CHUNK_TOKENS,
+                            help="Max tokens per Gemini request; 0 disables chunking.")
+    run_parser.add_argument("--concurrency", type=int, default=None, help="Workers for the OCR and Gemini stages.")
+    run_parser.add_argument("--preprocess", action="store_true", default=None,
+                            help="Skip blank/duplicate pages and re-render scans before OCR.")
+
+    resume_parser = subparsers.add_parser("resume", help="Resume an interrupted job.")
+    resume_parser.add_argument("job_id")
+    resume_parser.add_argument("--concurrency", type=int, default=None, help="Workers for the OCR and Gemini stages.")
+    resume_parser.add_argument("--preprocess", action="store_true", default=None,
+                               help="Skip blank/duplicate pages and re-render scans before OCR.")
+
+    status_parser = subparsers.add_parser("status", help="Show a job's per-file progress, or list all jobs.")
+    status_parser.add_argument("job_id", nargs="?")
+
+    cleanup_parser = subparsers.add_parser("cleanup", help="Delete old jobs and keep the store under its size limit.")
+    cleanup_parser.add_argument("--max-age-hours", type=float, default=JOB_RETENTION_HOURS,
+                                help=f"Delete jobs not updated for this long (default: {JOB_RETENTION_HOURS:g}).")
+    cleanup_parser.add_argument("--max-mb", type=int, default=JOB_STORE_MAX_BYTES // (1024 * 1024),
+                                help="Then delete the oldest jobs while the blobs take more than this.")
+
+    args = parser.parse_args(argv)
+    store = JobStore(args.store)
+
+    if args.command == "status":
+        if args.job_id:
+            job = store.get_job(args.job_id)
+            if job is None:
+                print(f"Unknown job: {args.job_id}", file=sys.stderr)
+                return 1
+            _print_job_status(job)
+        else:
+            for job in store.list_jobs():
+                print(f"{job['job_id']}  {job['status']:<10}  {job['model_name']}")
+        return 0
+
+    if args.command == "cleanup":
+        deleted_jobs = store.sweep(args.max_age_hours, args.max_mb * 1024 * 1024)
+        print(f"Deleted {deleted_jobs} job(s).")
+        return 0
+
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        print("Set the GEMINI_API_KEY environment variable.", file=sys.stderr)
+        return 1
+
+    if args.command == "run":
+        with open(args.rules, "r", encoding="utf-8") as f:
+            rules_prompt = f.read()
+        job_id = store.create_job(args.pdfs, rules_prompt, args.model, args.chunk_tokens or None)
+        print(f"Created job {job_id}")
+    else:
+        job_id = args.job_id
+        job = store.get_job(job_id)
+        if job is None:
+            print(f"Unknown job: {job_id}", file=sys.stderr)
+            return 1
+        if job["status"] == "completed":
+            print(f"Job {job_id} is already completed.", file=sys.stderr)
+            return 1
+
+    _, merged_path = run_job(store, job_id, api_key, concurrency=args.concurrency, progress_callback=_print_progress,
+                             preprocess=args.preprocess)
+    _print_job_status(store.get_job(job_id))
+    if merged_path:
+        print(f"Merged document: {merged_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())